@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
-import os
+import collections
+import itertools
 import sys
-from logging import critical, warning
+from logging import critical, debug, info
 
 import act
+from act.fact import RelevantFactBindings, RelevantObjectBindings
+import catalogue
+import metrics
+import workers
+from submit import use_session
 
 
-def parseargs():
+def parseargs(argv=None):
     """ Parse arguments """
     parser = argparse.ArgumentParser(description="ACT Bootstrap data model")
     parser.add_argument(
@@ -47,87 +52,322 @@ def parseargs():
         dest="act_baseurl",
         required=True,
         help="API URI")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the types and bindings that would be created, without creating them")
+    workers.add_arguments(parser)
+    metrics.add_arguments(parser)
 
-    return parser.parse_args()
-
+    return parser.parse_args(argv)
 
-def create_object_types(client, object_types_filename):
-    if not os.path.isfile(object_types_filename):
-        critical("Object defintion file not found: %s" % object_types_filename)
-        sys.exit(1)
 
+def load_types(args):
+    """
+    Load (object types, fact types, meta fact types) definitions from the
+    type catalogue, exit if a file is missing or invalid
+    """
     try:
-        object_types = json.loads(open(object_types_filename).read())
-    except json.decoder.JSONDecodeError:
-        critical("Unable to parse file as json: %s" % object_types_filename)
+        types = catalogue.load(
+            args.object_types_filename,
+            args.fact_types_filename,
+            args.meta_fact_types_filename)
+    except catalogue.CatalogueError as e:
+        for problem in e.problems:
+            critical(problem)
         sys.exit(1)
 
-    existing_object_types = [object_type.name
-                             for object_type in client.get_object_types()]
+    return types.definitions
 
-    # Create all objects
-    for object_type in object_types:
-        name = object_type["name"]
-        validator = object_type.get("validator", act.DEFAULT_VALIDATOR)
 
-        if name in existing_object_types:
-            warning("Object type %s already exists" % name)
-            continue
+def as_list(value):
+    "Encapsulate value in list if value is not already a list"
 
-        client.object_type(name=name, validator_parameter=validator).add()
+    if not isinstance(value, list):
+        return [value]
 
+    return value
 
-def create_fact_types(client, fact_types_filename):
-    # Create fact type with allowed bindings to ALL objects
-    # We want to change this later, but keep it like this to make it simpler
-    # when evaluating the data model
 
-    if not os.path.isfile(fact_types_filename):
-        critical("Facts defintion file not found: %s" % fact_types_filename)
+def object_bindings_of(fact_type):
+    """ Set of (source, destination, bidirectional) object type names bound to existing fact type """
+    return {(binding.source_object_type.name,
+             binding.destination_object_type.name,
+             binding.bidirectional_binding)
+            for binding in fact_type.relevant_object_bindings or []}
 
-    try:
-        fact_types = json.loads(open(fact_types_filename).read())
-    except json.decoder.JSONDecodeError:
-        critical("Unable to parse file as json: %s" % fact_types_filename)
-        sys.exit(1)
+
+def fact_bindings_of(fact_type):
+    """ Set of fact type names bound to existing meta fact type """
+    return {binding.name for binding in fact_type.relevant_fact_bindings or []}
+
+
+def wanted_object_bindings(fact_type, object_type_names):
+    """
+    Set of (source, destination, bidirectional) object type names defined for fact_type.
+    Fact types without objectBindings are bound to all object types.
+    """
+    object_bindings = fact_type.get("objectBindings", [])
+
+    if not object_bindings:
+        return set(itertools.product(object_type_names, object_type_names, [True, False]))
+
+    return {binding
+            for object_binding in object_bindings
+            for binding in itertools.product(
+                as_list(object_binding.get("sourceObjectType")),
+                as_list(object_binding.get("destinationObjectType")),
+                [object_binding.get("bidirectional", False)])}
+
+
+class Plan(object):
+    """ Changes needed to bring the platform in line with the type definitions """
+
+    def __init__(self):
+        self.object_types = []      # Object type definitions to create
+        self.fact_types = []        # (definition, bindings) to create
+        self.object_bindings = []   # (existing fact type, bindings) to add
+        self.meta_fact_types = []   # (definition, fact type names) to create
+        self.fact_bindings = []     # (existing meta fact type, fact type names) to add
+
+    def __bool__(self):
+        return any((self.object_types, self.fact_types, self.object_bindings,
+                    self.meta_fact_types, self.fact_bindings))
+
+    def __str__(self):
+        out = []
+
+        for object_type in self.object_types:
+            out.append("+ objectType %s" % object_type["name"])
+
+        for (name, bindings) in \
+                [(fact_type["name"], bindings) for (fact_type, bindings) in self.fact_types] + \
+                [(fact_type.name, bindings) for (fact_type, bindings) in self.object_bindings]:
+            for (source, destination, bidirectional) in sorted(bindings, key=str):
+                out.append("+ factType %s: %s %s %s" % (
+                    name, source, "<->" if bidirectional else "->", destination))
+
+        for (name, bindings) in \
+                [(fact_type["name"], bindings) for (fact_type, bindings) in self.meta_fact_types] + \
+                [(fact_type.name, bindings) for (fact_type, bindings) in self.fact_bindings]:
+            for fact_type_name in sorted(bindings):
+                out.append("+ metaFactType %s: %s" % (name, fact_type_name))
+
+        return "\n".join(out)
+
+
+def reconcile(client, object_types, fact_types, meta_fact_types):
+    """
+    Load existing object and fact types in one pass and compute the
+    types and bindings that must be created
+    """
+    existing_object_types = {object_type.name: object_type
+                             for object_type in client.get_object_types()}
+    existing_fact_types = {fact_type.name: fact_type
+                           for fact_type in client.get_fact_types()}
+
+    plan = Plan()
+
+    for object_type in object_types:
+        if object_type["name"] in existing_object_types:
+            debug("Object type %s already exists" % object_type["name"])
+            continue
+        plan.object_types.append(object_type)
+
+    object_type_names = set(existing_object_types) | {object_type["name"] for object_type in object_types}
 
     for fact_type in fact_types:
         name = fact_type["name"]
-        validator = fact_type.get("validator", act.DEFAULT_VALIDATOR)
-        object_bindings = fact_type.get("objectBindings", [])
+        bindings = wanted_object_bindings(fact_type, object_type_names)
+
+        if name not in existing_fact_types:
+            plan.fact_types.append((fact_type, bindings))
+            continue
 
-        if not object_bindings:
-            client.create_fact_type_all_bindings(
-                name, validator_parameter=validator)
+        new_bindings = bindings - object_bindings_of(existing_fact_types[name])
 
+        if new_bindings:
+            plan.object_bindings.append((existing_fact_types[name], new_bindings))
         else:
-            client.create_fact_type(name, validator=validator, object_bindings=object_bindings)
+            debug("Fact type %s already exists with all bindings" % name)
 
+    # Meta fact types without factBindings are bound to all (non meta) fact types
+    plain_fact_type_names = {name
+                             for (name, fact_type) in existing_fact_types.items()
+                             if not fact_type.relevant_fact_bindings} | \
+                            {fact_type["name"] for fact_type in fact_types}
 
-def create_meta_fact_types(client, meta_fact_types_filename):
-    # Create fact type with allowed bindings to ALL objects
-    # We want to change this later, but keep it like this to make it simpler
-    # when evaluating the data model
+    for meta_fact_type in meta_fact_types:
+        name = meta_fact_type["name"]
+        bindings = set(meta_fact_type.get("factBindings", [])) or plain_fact_type_names
 
-    if not os.path.isfile(meta_fact_types_filename):
-        critical("Meta Fact defintions file not found: %s" % meta_fact_types_filename)
+        if name not in existing_fact_types:
+            plan.meta_fact_types.append((meta_fact_type, bindings))
+            continue
 
-    try:
-        meta_fact_types = json.loads(open(meta_fact_types_filename).read())
-    except json.decoder.JSONDecodeError:
-        critical("Unable to parse file as json: %s" % meta_fact_types_filename)
+        new_bindings = bindings - fact_bindings_of(existing_fact_types[name])
+
+        if new_bindings:
+            plan.fact_bindings.append((existing_fact_types[name], new_bindings))
+        else:
+            debug("Meta fact type %s already exists with all bindings" % name)
+
+    errors = undefined_references(
+        plan,
+        object_type_names,
+        set(existing_fact_types) |
+        {fact_type["name"] for fact_type in fact_types} |
+        {meta_fact_type["name"] for meta_fact_type in meta_fact_types})
+
+    if errors:
+        for message in errors:
+            critical(message)
         sys.exit(1)
 
-    for meta_fact_type in meta_fact_types:
-        name = meta_fact_type["name"]
-        validator = meta_fact_type.get("validator", act.DEFAULT_VALIDATOR)
-        fact_bindings = meta_fact_type.get("factBindings", [])
+    return (plan, existing_object_types, existing_fact_types)
 
-        if not fact_bindings:
-            client.create_meta_fact_type_all_bindings(name, validator_parameter=validator)
 
-        else:
-            client.create_meta_fact_type(name, fact_bindings=fact_bindings, validator=validator)
+def undefined_references(plan, object_type_names, fact_type_names):
+    """ List of bindings in plan that reference types that are neither defined nor existing """
+    errors = []
+
+    for (fact_type, bindings) in \
+            [(fact_type["name"], bindings) for (fact_type, bindings) in plan.fact_types] + \
+            [(fact_type.name, bindings) for (fact_type, bindings) in plan.object_bindings]:
+        for binding in bindings:
+            for object_type in binding[:2]:
+                if object_type is not None and object_type not in object_type_names:
+                    errors.append("Fact type %s is bound to undefined object type %s" % (fact_type, object_type))
+
+    for (meta_fact_type, bindings) in \
+            [(fact_type["name"], bindings) for (fact_type, bindings) in plan.meta_fact_types] + \
+            [(fact_type.name, bindings) for (fact_type, bindings) in plan.fact_bindings]:
+        for fact_type in bindings:
+            if fact_type not in fact_type_names:
+                errors.append("Meta fact type %s is bound to undefined fact type %s" % (meta_fact_type, fact_type))
+
+    return sorted(set(errors))
+
+
+def dependency_levels(plan):
+    """
+    Group the changes in plan by depth in the dependency graph: object types,
+    then fact types bound to them, then meta fact types bound to those fact
+    types (and so on, for meta fact types bound to other meta fact types).
+
+    Returns list of levels, each a list of (kind, item) that only depend on
+    changes at earlier levels.
+    """
+    nodes = {}
+
+    for object_type in plan.object_types:
+        nodes[("objectType", object_type["name"])] = (("objectType", object_type), set())
+
+    for (kind, changes) in (("factType", plan.fact_types), ("objectBindings", plan.object_bindings)):
+        for (fact_type, bindings) in changes:
+            name = fact_type["name"] if kind == "factType" else fact_type.name
+            nodes[("factType", name)] = (
+                (kind, (fact_type, bindings)),
+                {("objectType", object_type) for binding in bindings for object_type in binding[:2]})
+
+    for (kind, changes) in (("metaFactType", plan.meta_fact_types), ("factBindings", plan.fact_bindings)):
+        for (fact_type, bindings) in changes:
+            name = fact_type["name"] if kind == "metaFactType" else fact_type.name
+            nodes[("factType", name)] = (
+                (kind, (fact_type, bindings)),
+                {("factType", fact_type_name) for fact_type_name in bindings})
+
+    depth = {}
+
+    def node_depth(node, path=()):
+        if node not in depth:
+            if node in path:
+                critical("Circular type bindings: %s" % " -> ".join(name for (_, name) in path + (node,)))
+                sys.exit(1)
+
+            depth[node] = 1 + max(
+                [node_depth(dependency, path + (node,))
+                 for dependency in nodes[node][1]
+                 if dependency in nodes and dependency != node],
+                default=-1)
+
+        return depth[node]
+
+    levels = collections.defaultdict(list)
+
+    for node in nodes:
+        levels[node_depth(node)].append(nodes[node][0])
+
+    return [levels[level] for level in sorted(levels)]
+
+
+def apply_plan(client, plan, existing_object_types, existing_fact_types, worker_count=1):
+    """
+    Create the types and bindings in plan. Changes are applied one
+    dependency level at a time, with up to worker_count concurrent
+    requests for the independent changes within a level.
+    """
+
+    object_types = dict(existing_object_types)
+    object_types[None] = None
+
+    fact_types = dict(existing_fact_types)
+
+    def relevant_object_bindings(bindings):
+        return [RelevantObjectBindings(object_types[source], object_types[destination], bidirectional)
+                for (source, destination, bidirectional) in bindings]
+
+    def relevant_fact_bindings(bindings):
+        return [RelevantFactBindings(name=name, id=fact_types[name].id) for name in bindings]
+
+    def apply_change(change):
+        (kind, item) = change
+
+        if kind == "objectType":
+            object_types[item["name"]] = client.object_type(
+                name=item["name"],
+                validator_parameter=item.get("validator", act.DEFAULT_VALIDATOR)).add()
+
+        elif kind == "factType":
+            (fact_type, bindings) = item
+            fact_types[fact_type["name"]] = client.fact_type(
+                name=fact_type["name"],
+                validator_parameter=fact_type.get("validator", act.DEFAULT_VALIDATOR),
+                relevant_object_bindings=relevant_object_bindings(bindings)).add()
+
+        elif kind == "objectBindings":
+            (fact_type, bindings) = item
+            fact_type.add_object_bindings(relevant_object_bindings(bindings))
+
+        elif kind == "metaFactType":
+            (meta_fact_type, bindings) = item
+            fact_types[meta_fact_type["name"]] = client.fact_type(
+                name=meta_fact_type["name"],
+                validator_parameter=meta_fact_type.get("validator", act.DEFAULT_VALIDATOR),
+                relevant_fact_bindings=relevant_fact_bindings(bindings)).add()
+
+        elif kind == "factBindings":
+            (meta_fact_type, bindings) = item
+            meta_fact_type.add_fact_bindings(relevant_fact_bindings(bindings))
+
+    for (level, changes) in enumerate(dependency_levels(plan)):
+        info("Applying %d type changes at dependency level %d" % (len(changes), level))
+        workers.run(apply_change, changes, worker_count)
+
+
+def bootstrap_types(client, args):
+    """ Create the types and bindings that are missing, or print them with --plan """
+    with metrics.phase("types_reconcile"):
+        (plan, existing_object_types, existing_fact_types) = reconcile(client, *load_types(args))
+
+    for (kind, changes) in vars(plan).items():
+        metrics.inc("type_changes_total", len(changes), kind=kind)
+
+    if args.plan:
+        print(plan or "No changes")
+    else:
+        with metrics.phase("types_apply"):
+            apply_plan(client, plan, existing_object_types, existing_fact_types, args.workers)
 
 
 if __name__ == "__main__":
@@ -139,7 +379,10 @@ if __name__ == "__main__":
         args.log_level,
         args.log_file,
         "act-types")
-    create_object_types(
-        client, object_types_filename=args.object_types_filename)
-    create_fact_types(client, fact_types_filename=args.fact_types_filename)
-    create_meta_fact_types(client, meta_fact_types_filename=args.meta_fact_types_filename)
+
+    metrics.configure(args)
+    use_session(client, workers.session_from_args(args))
+
+    bootstrap_types(client, args)
+
+    metrics.finish(args)
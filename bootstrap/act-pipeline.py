@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+"""
+Bootstrap the data model and all open sources in one process
+
+The type bootstrap runs first, and the importers then run concurrently,
+sharing one ACT client, one pooled session, one fact submitter and one
+alias graph. Completed stages are recorded in a state file, so a failed
+run can be resumed with --resume.
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+from logging import critical, info
+
+import act
+import aliases
+import catalogue
+import checkpoint
+import factstore
+import httpcache
+import metrics
+import workers
+from submit import FactSubmitter
+
+BOOTSTRAP_HOME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_STATE_FILE = os.path.expanduser("~/.cache/act-bootstrap/pipeline.json")
+
+types = importlib.import_module("act-bootstrap")
+mitre = importlib.import_module("mitre-attack")
+misp = importlib.import_module("misp-threat-actors")
+carbanak = importlib.import_module("fireeye-carbanak")
+
+
+def parseargs():
+    """ Parse arguments """
+    parser = argparse.ArgumentParser(description="ACT Bootstrap pipeline (types and all open sources)")
+    parser.add_argument(
+        "--userid",
+        dest="user_id",
+        required=True,
+        help="User ID")
+    parser.add_argument(
+        "--act-baseurl",
+        dest="act_baseurl",
+        required=True,
+        help="API URI")
+    parser.add_argument(
+        "--logfile",
+        dest="log_file",
+        help="Log to file (default = stdout)")
+    parser.add_argument(
+        "--loglevel",
+        dest="log_level",
+        default="info",
+        help="Loglevel (default = info)")
+    parser.add_argument(
+        "--object-types",
+        dest="object_types_filename",
+        help="Object type defintions (json), default = object-types.json in --types-dir")
+    parser.add_argument(
+        "--fact-types",
+        dest="fact_types_filename",
+        help="Fact type defintions (json), default = fact-types.json in --types-dir")
+    parser.add_argument(
+        "--meta-fact-types",
+        dest="meta_fact_types_filename",
+        help="Meta Fact type defintions (json), default = metafact-types.json in --types-dir")
+    parser.add_argument(
+        "--md5-lookup",
+        dest="md5_lookup",
+        default=os.path.join(BOOTSTRAP_HOME, "data", "carbanak_md5_sha256.txt"),
+        help="md5,sha256 lookup for the carbanak report")
+    parser.add_argument(
+        "--from-dump",
+        dest="from_dump",
+        help="Read att&ck from a mitre-attack.py --dump directory, instead of querying att&ck")
+    parser.add_argument(
+        "--models",
+        dest="attack_models",
+        help="Models for the mitre-attack stage (all, attack or pre-attack). Default = all")
+    parser.add_argument(
+        "--cluster",
+        dest="misp_clusters",
+        action="append",
+        choices=sorted(misp.CLUSTERS),
+        help="Galaxy cluster for the misp-threat-actors stage, may be repeated (default = threat-actor)")
+    parser.add_argument(
+        "--all-clusters",
+        dest="misp_all_clusters",
+        action="store_true",
+        help="Import all supported galaxy clusters in the misp-threat-actors stage")
+    parser.add_argument(
+        "--report",
+        dest="carbanak_report",
+        help="Report (xlsx) url or filename for the fireeye-carbanak stage (default = %s)" % carbanak.CARBANAK_REPORT_URL)
+    parser.add_argument(
+        "--report-config",
+        dest="carbanak_report_config",
+        help="Sheet name, header rows and columns of the report (json), default is the carbanak report")
+    parser.add_argument(
+        "--stages",
+        default=",".join(DEFAULT_STAGES),
+        help="Comma separated list of stages (%s), default = %s" % (
+            ", ".join(STAGES), ",".join(DEFAULT_STAGES)))
+    parser.add_argument(
+        "--from-stage",
+        dest="from_stage",
+        choices=list(STAGES),
+        help="Skip the stages before this stage")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the stages that completed in the previous run, and continue failed stages from their checkpoints")
+    parser.add_argument(
+        "--state-file",
+        dest="state_file",
+        default=DEFAULT_STATE_FILE,
+        help="Completed stages and their timing (default = %s)" % DEFAULT_STATE_FILE)
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        default=500,
+        help="Number of facts to send per batch (default = 500)")
+    parser.add_argument(
+        "--max-in-flight",
+        dest="max_in_flight",
+        type=int,
+        default=10,
+        help="Maximum number of concurrent requests to the ACT API (default = 10)")
+    workers.add_arguments(parser)
+    factstore.add_arguments(parser)
+    httpcache.add_arguments(parser)
+    aliases.add_arguments(parser)
+    catalogue.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    # The types stage bootstraps the same definitions that facts are checked against
+    (args.object_types_filename, args.fact_types_filename, args.meta_fact_types_filename) = \
+        catalogue.type_files(args)
+
+    args.stages = [stage for stage in args.stages.split(",") if stage]
+
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error("Unknown stage: %s" % stage)
+
+    return args
+
+
+def stage_args(module, argv, args):
+    """
+    Parse arguments for the stage in module, with defaults from the stage
+    and the options shared by all stages taken from the pipeline arguments.
+    argv has the required arguments and the options specific to the stage.
+    """
+    parsed = module.parseargs(["--userid", str(args.user_id), "--act-baseurl", args.act_baseurl] + argv)
+
+    for (name, value) in vars(args).items():
+        if hasattr(parsed, name):
+            setattr(parsed, name, value)
+
+    return parsed
+
+
+class Pipeline(object):
+    """ Client, submitter and alias graph shared by the stages """
+
+    def __init__(self, args):
+        self.args = args
+
+        self.client = act.Act(
+            args.act_baseurl,
+            args.user_id,
+            args.log_level,
+            args.log_file,
+            "act-pipeline")
+
+        httpcache.configure(args)
+
+        self.submitter = FactSubmitter(
+            self.client,
+            args.batch_size,
+            args.max_in_flight,
+            workers.session_from_args(args, pool_size=args.max_in_flight),
+            factstore.from_args(args, self.client),
+            catalogue.from_args(args))
+
+        self.alias_graph = aliases.AliasGraph()
+        self.checkpoints = {}
+
+    def checkpoint(self, stage, args):
+        """ Checkpoint of stage, committed when the shared submitter sends a batch """
+        progress = checkpoint.from_args(args, stage, self.client)
+        self.submitter.add_checkpoint(progress)
+        self.checkpoints[stage] = progress
+        return progress
+
+    def close(self):
+        """ Submit aliases from all stages and the remaining facts """
+        with metrics.phase("aliases_submit"):
+            self.alias_graph.submit(self.submitter)
+
+        if self.args.alias_clusters:
+            self.alias_graph.write_clusters(self.args.alias_clusters)
+
+        with metrics.phase("submit_flush"):
+            self.submitter.close()
+
+
+def run_types(pipeline):
+    args = stage_args(types, [
+        "--object-types", pipeline.args.object_types_filename,
+        "--fact-types", pipeline.args.fact_types_filename,
+        "--meta-fact-types", pipeline.args.meta_fact_types_filename], pipeline.args)
+
+    types.bootstrap_types(pipeline.client, args)
+
+
+def options(*pairs):
+    """ Command line options for the (option, value) pairs where value is given """
+    argv = []
+
+    for (option, value) in pairs:
+        if value is True:
+            argv.append(option)
+        elif isinstance(value, list):
+            for item in value:
+                argv += [option, item]
+        elif value:
+            argv += [option, value]
+
+    return argv
+
+
+def run_mitre_attack(pipeline):
+    args = stage_args(mitre, options(("--models", pipeline.args.attack_models)), pipeline.args)
+
+    mitre.insert_attack(
+        pipeline.submitter,
+        pipeline.alias_graph,
+        mitre.fetch_categories(args),
+        args.models,
+        args.workers,
+        pipeline.checkpoint("mitre-attack", args))
+
+
+def run_misp_threat_actors(pipeline):
+    args = stage_args(misp, options(
+        ("--cluster", pipeline.args.misp_clusters),
+        ("--all-clusters", pipeline.args.misp_all_clusters)), pipeline.args)
+
+    misp.add_clusters(pipeline.submitter, pipeline.alias_graph, args.clusters, args.workers)
+
+
+def run_fireeye_carbanak(pipeline):
+    args = stage_args(carbanak, ["--md5-lookup", pipeline.args.md5_lookup] + options(
+        ("--report", pipeline.args.carbanak_report),
+        ("--report-config", pipeline.args.carbanak_report_config)), pipeline.args)
+
+    carbanak.carbanak_report(
+        pipeline.submitter,
+        carbanak.get_md5_lookup(args.md5_lookup),
+        args.workers,
+        args.report,
+        carbanak.load_columns(args.report_config),
+        pipeline.checkpoint("fireeye-carbanak", args))
+
+
+# Stages in pipeline order. The type bootstrap runs first, and all other
+# stages run concurrently once it has completed.
+STAGES = {
+    "types": run_types,
+    "mitre-attack": run_mitre_attack,
+    "misp-threat-actors": run_misp_threat_actors,
+    "fireeye-carbanak": run_fireeye_carbanak,
+}
+
+# Same stages as scripts/act-bootstrap.sh
+DEFAULT_STAGES = ["types", "misp-threat-actors", "fireeye-carbanak"]
+
+
+def load_state(filename):
+    """ Completed stages from the previous run: stage -> seconds """
+    try:
+        with open(filename) as f:
+            return json.load(f)["completed"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_state(filename, completed):
+    """ Write completed stages atomically """
+    directory = os.path.dirname(filename) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    (fd, tmp) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"completed": completed}, f, indent=2)
+    os.replace(tmp, filename)
+
+
+def selected_stages(args, completed):
+    """ Stages to run, in pipeline order """
+    stages = [stage for stage in STAGES if stage in args.stages]
+
+    if args.from_stage:
+        stages = [stage for stage in stages if list(STAGES).index(stage) >= list(STAGES).index(args.from_stage)]
+
+    if args.resume:
+        for stage in stages:
+            if stage in completed:
+                info("Skipping stage %s, completed in previous run" % stage)
+        stages = [stage for stage in stages if stage not in completed]
+
+    return stages
+
+
+def run(args):
+    """ Run pipeline, return True if all stages completed """
+    completed = load_state(args.state_file) if args.resume else {}
+    stages = selected_stages(args, completed)
+
+    metrics.configure(args)
+
+    pipeline = Pipeline(args)
+    failed = []
+
+    def run_stage(stage):
+        info("Starting stage %s" % stage)
+        start = time.time()
+        with metrics.timer("stage_seconds", stage=stage):
+            STAGES[stage](pipeline)
+        completed[stage] = round(time.time() - start, 3)
+        info("Completed stage %s in %.1f seconds" % (stage, completed[stage]))
+
+    start = time.time()
+
+    if "types" in stages:
+        run_stage("types")
+        save_state(args.state_file, completed)
+
+    importers = [stage for stage in stages if stage != "types"]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(importers), 1)) as executor:
+        futures = {executor.submit(run_stage, stage): stage for stage in importers}
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                critical("Stage %s failed: %s" % (futures[future], e))
+                failed.append(futures[future])
+
+    # Facts from the completed stages are sent before they are recorded as completed
+    pipeline.close()
+    save_state(args.state_file, completed)
+
+    # Failed stages keep their checkpoints, and continue from them with --resume
+    for (stage, progress) in pipeline.checkpoints.items():
+        if stage not in failed:
+            progress.finish()
+
+    info("Pipeline completed in %.1f seconds: %s" % (
+        time.time() - start,
+        ", ".join("%s %.1fs" % (stage, seconds) for (stage, seconds) in completed.items())))
+
+    if failed:
+        critical("Failed stages: %s (rerun with --resume to continue)" % ", ".join(failed))
+
+    metrics.finish(args)
+
+    return not failed
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(parseargs()) else 1)
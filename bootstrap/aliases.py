@@ -0,0 +1,84 @@
+""" Alias graph, collecting alias facts from all sources before they are submitted """
+
+import json
+import threading
+from logging import info
+
+
+def add_arguments(parser):
+    """ Add alias graph arguments to parser """
+    parser.add_argument(
+        "--alias-clusters",
+        dest="alias_clusters",
+        help="Write clusters of aliases (connected components of the alias facts) to file (json)")
+
+
+class AliasGraph(object):
+    """
+    Unordered alias pairs per (fact type, object type), and the clusters
+    of values connected by aliases (union-find). Each pair is submitted
+    once, with the values in sorted order, however many times and in
+    whichever direction it was added.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pairs = {}     # (fact type, object type) -> set of (value, value)
+        self.parent = {}    # (fact type, object type, value) -> parent in union-find
+        self.added = 0
+
+    def find(self, node):
+        """ Root of node in union-find, with path halving """
+        self.parent.setdefault(node, node)
+
+        while self.parent[node] != node:
+            self.parent[node] = self.parent[self.parent[node]]
+            node = self.parent[node]
+
+        return node
+
+    def add(self, fact_type, object_type, value, aliases):
+        """ Add alias pairs between value and each of aliases """
+        if isinstance(aliases, str):
+            aliases = [aliases]
+
+        with self.lock:
+            for alias in aliases:
+                if alias == value:
+                    continue  # Do not alias to ourself
+
+                self.added += 1
+                self.pairs.setdefault((fact_type, object_type), set()).add(tuple(sorted((value, alias))))
+
+                (root, other) = (self.find((fact_type, object_type, value)),
+                                 self.find((fact_type, object_type, alias)))
+                if root != other:
+                    self.parent[max(root, other)] = min(root, other)
+
+    def __len__(self):
+        return sum(len(pairs) for pairs in self.pairs.values())
+
+    def submit(self, submitter):
+        """ Submit one bidirectional fact for each unique alias pair """
+        info("Submitting %d unique alias facts (%d added)" % (len(self), self.added))
+
+        for ((fact_type, object_type), pairs) in sorted(self.pairs.items()):
+            for (value, alias) in sorted(pairs):
+                submitter.submit(submitter.client.fact(fact_type)
+                                 .bidirectional(object_type, value, object_type, alias))
+
+    def clusters(self):
+        """ List of clusters of aliases: {"factType", "objectType", "values"} """
+        clusters = {}
+
+        with self.lock:
+            for node in self.parent:
+                clusters.setdefault(self.find(node), []).append(node[2])
+
+        return [{"factType": root[0], "objectType": root[1], "values": sorted(values)}
+                for (root, values) in sorted(clusters.items())]
+
+    def write_clusters(self, filename):
+        """ Write alias clusters to file (json) """
+        with open(filename, "w") as f:
+            json.dump(self.clusters(), f, indent=2)
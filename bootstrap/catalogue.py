@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""
+Type catalogue: the object, fact and meta fact type definitions in types/,
+validated, cross-referenced and indexed
+
+The definitions are compiled to a canonically sorted form, with the
+object bindings of each fact type expanded. Importers use the catalogue
+to catch facts of unknown types before they are sent to the platform.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+from logging import critical, error, warning
+
+import metrics
+
+DEFAULT_TYPES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "types")
+
+# Definition files in types/, in dependency order
+OBJECT_TYPES = "object-types.json"
+FACT_TYPES = "fact-types.json"
+META_FACT_TYPES = "metafact-types.json"
+
+
+def add_arguments(parser):
+    """ Add type check arguments to parser """
+    parser.add_argument(
+        "--types-dir",
+        dest="types_dir",
+        default=DEFAULT_TYPES_DIR,
+        help="Type definitions that facts are checked against (default = types/ of act-bootstrap)")
+    parser.add_argument(
+        "--type-check",
+        dest="type_check",
+        choices=("warn", "strict", "off"),
+        default="warn",
+        help="Log facts of unknown types or bindings (warn), or also skip them (strict). Default = warn")
+
+
+class CatalogueError(ValueError):
+    """ Definitions that can not be loaded, with one message per problem """
+
+    def __init__(self, problems):
+        super().__init__("\n".join(problems))
+        self.problems = problems
+
+
+def as_list(value):
+    """ Encapsulate value in list if value is not already a list """
+    if not isinstance(value, list):
+        return [value]
+
+    return value
+
+
+def sort_definitions(definitions):
+    """ Definitions sorted by name (keys are sorted when written) """
+    return sorted(definitions, key=lambda definition: definition["name"])
+
+
+def dumps(definitions):
+    """ Canonical json of definitions, as written to types/ """
+    return json.dumps(sort_definitions(definitions), indent=2, sort_keys=True, ensure_ascii=False) + "\n"
+
+
+def parse(text, filename, description):
+    """ List of definitions in text, raise CatalogueError if they are invalid """
+    try:
+        definitions = json.loads(text)
+    except ValueError:
+        raise CatalogueError(["Unable to parse file as json: %s" % filename])
+
+    if not isinstance(definitions, list) or \
+            not all(isinstance(definition, dict) and isinstance(definition.get("name"), str)
+                    for definition in definitions):
+        raise CatalogueError(["%s definitions must be a list of objects with a name: %s" % (description, filename)])
+
+    return definitions
+
+
+def object_bindings(fact_type):
+    """
+    Sorted list of [source, destination, bidirectional] defined for fact_type,
+    or None for fact types without objectBindings, which are bound to all object types
+    """
+    if not fact_type.get("objectBindings"):
+        return None
+
+    return sorted({binding
+                   for object_binding in fact_type["objectBindings"]
+                   for binding in itertools.product(
+                       as_list(object_binding.get("sourceObjectType")),
+                       as_list(object_binding.get("destinationObjectType")),
+                       [object_binding.get("bidirectional", False)])},
+                  key=str)
+
+
+def compile_catalogue(object_types, fact_types, meta_fact_types):
+    """
+    Compiled catalogue of the definitions. Duplicate names raise CatalogueError,
+    while bindings to undefined types are listed in "undefined", since they
+    may exist on the platform.
+    """
+    problems = []
+    seen = {}
+
+    for (kind, definitions) in (("object type", object_types),
+                                ("fact type", fact_types),
+                                ("meta fact type", meta_fact_types)):
+        for definition in definitions:
+            # Fact types and meta fact types share a namespace on the platform
+            namespace = "objectType" if kind == "object type" else "factType"
+            if (namespace, definition["name"]) in seen:
+                problems.append("Duplicate definition of %s %s (also defined as %s)" % (
+                    kind, definition["name"], seen[(namespace, definition["name"])]))
+            seen[(namespace, definition["name"])] = kind
+
+    if problems:
+        raise CatalogueError(problems)
+
+    object_type_names = {object_type["name"] for object_type in object_types}
+    fact_type_names = {fact_type["name"] for fact_type in fact_types + meta_fact_types}
+
+    bindings = {fact_type["name"]: object_bindings(fact_type) for fact_type in fact_types}
+    undefined = set()
+
+    for (name, fact_type_bindings) in bindings.items():
+        for binding in fact_type_bindings or []:
+            for object_type in binding[:2]:
+                if object_type is not None and object_type not in object_type_names:
+                    undefined.add("Fact type %s is bound to undefined object type %s" % (name, object_type))
+
+    for meta_fact_type in meta_fact_types:
+        for fact_type in meta_fact_type.get("factBindings", []):
+            if fact_type not in fact_type_names:
+                undefined.add("Meta fact type %s is bound to undefined fact type %s" % (
+                    meta_fact_type["name"], fact_type))
+
+    return {
+        "objectTypes": sort_definitions(object_types),
+        "factTypes": sort_definitions(fact_types),
+        "metaFactTypes": sort_definitions(meta_fact_types),
+        "bindings": bindings,
+        "undefined": sorted(undefined),
+    }
+
+
+class Catalogue(object):
+    """ Index of a compiled catalogue """
+
+    def __init__(self, compiled):
+        self.definitions = (compiled["objectTypes"], compiled["factTypes"], compiled["metaFactTypes"])
+        self.object_types = {definition["name"]: definition for definition in compiled["objectTypes"]}
+        self.fact_types = {definition["name"]: definition for definition in compiled["factTypes"]}
+        self.meta_fact_types = {definition["name"]: definition for definition in compiled["metaFactTypes"]}
+        self.bindings = {name: None if bindings is None else {tuple(binding) for binding in bindings}
+                         for (name, bindings) in compiled["bindings"].items()}
+        self.undefined = compiled["undefined"]
+
+    def bound(self, fact_type, source, destination, bidirectional):
+        """ True if fact_type is bound to (source, destination, bidirectional) """
+        bindings = self.bindings[fact_type]
+
+        # Same as act-bootstrap.py, which binds these to all pairs of object types
+        if bindings is None:
+            return source in self.object_types and destination in self.object_types
+
+        return (source, destination, bidirectional) in bindings or \
+            (bidirectional and (destination, source, bidirectional) in bindings)
+
+    def check(self, fact):
+        """ List of problems with the types of fact (an act.fact.Fact), empty if it is valid """
+        name = fact.type.name
+
+        if name in self.meta_fact_types:
+            return []
+
+        if name not in self.fact_types:
+            return ["Unknown fact type %s" % name]
+
+        source = fact.source_object.type.name if fact.source_object else None
+        destination = fact.destination_object.type.name if fact.destination_object else None
+
+        problems = ["Unknown object type %s" % object_type
+                    for object_type in (source, destination)
+                    if object_type is not None and object_type not in self.object_types]
+
+        if not problems and not self.bound(name, source, destination, bool(fact.bidirectional_binding)):
+            problems.append("Fact type %s is not bound to %s %s %s" % (
+                name, source, "<->" if fact.bidirectional_binding else "->", destination))
+
+        return problems
+
+
+def load(object_types_filename=None, fact_types_filename=None, meta_fact_types_filename=None):
+    """
+    Load catalogue from the definition files (default types/). Raises
+    CatalogueError if the files are missing or invalid.
+    """
+    filenames = (
+        (object_types_filename or os.path.join(DEFAULT_TYPES_DIR, OBJECT_TYPES), "Object"),
+        (fact_types_filename or os.path.join(DEFAULT_TYPES_DIR, FACT_TYPES), "Fact"),
+        (meta_fact_types_filename or os.path.join(DEFAULT_TYPES_DIR, META_FACT_TYPES), "Meta Fact"))
+
+    definitions = []
+
+    for (filename, description) in filenames:
+        try:
+            with open(filename, encoding="utf8") as f:
+                text = f.read()
+        except OSError:
+            raise CatalogueError(["%s defintion file not found: %s" % (description, filename)])
+
+        definitions.append(parse(text, filename, description))
+
+    return Catalogue(compile_catalogue(*definitions))
+
+
+def load_dir(directory=DEFAULT_TYPES_DIR):
+    """ Load catalogue from the definition files in directory """
+    return load(os.path.join(directory, OBJECT_TYPES),
+                os.path.join(directory, FACT_TYPES),
+                os.path.join(directory, META_FACT_TYPES))
+
+
+class FactCheck(object):
+    """
+    Check facts against the catalogue before they are submitted. Each
+    distinct problem is logged once, as an error if strict (the fact is
+    skipped) and as a warning otherwise, and invalid facts are counted in
+    the invalid_facts_total metric.
+    """
+
+    def __init__(self, catalogue, strict=False):
+        self.catalogue = catalogue
+        self.strict = strict
+        self.logged = set()
+
+    def accept(self, fact):
+        """ False if fact is invalid and should be skipped """
+        problems = self.catalogue.check(fact)
+
+        if not problems:
+            return True
+
+        metrics.inc("invalid_facts_total", fact_type=fact.type.name)
+
+        for problem in problems:
+            if problem not in self.logged:
+                self.logged.add(problem)  # Set operations are atomic, a duplicate log line is harmless
+                (error if self.strict else warning)("%s: %s" % (problem, fact))
+
+        return not self.strict
+
+
+def type_files(args):
+    """
+    (object types, fact types, meta fact types) definition files given on
+    the command line: --object-types, --fact-types and --meta-fact-types
+    where a script has them (like act-pipeline.py), otherwise the files in
+    --types-dir
+    """
+    return tuple(
+        getattr(args, dest, None) or os.path.join(args.types_dir, name)
+        for (dest, name) in (("object_types_filename", OBJECT_TYPES),
+                             ("fact_types_filename", FACT_TYPES),
+                             ("meta_fact_types_filename", META_FACT_TYPES)))
+
+
+def from_args(args):
+    """ Fact check given on the command line, or None with --type-check off. Exit if the types are invalid """
+    if args.type_check == "off":
+        return None
+
+    try:
+        return FactCheck(load(*type_files(args)), strict=args.type_check == "strict")
+    except CatalogueError as e:
+        for problem in e.problems:
+            critical(problem)
+        sys.exit(1)
+
+
+def sort_files(directory):
+    """ Write the definition files in directory in canonical order, return False if one is invalid """
+    ok = True
+
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+
+        filename = os.path.join(directory, name)
+
+        try:
+            with open(filename) as f:
+                definitions = parse(f.read(), filename, name)
+        except (OSError, CatalogueError) as e:
+            print("error occured during sort of %s: %s" % (name, e))
+            ok = False
+            continue
+
+        (fd, tmp) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            f.write(dumps(definitions))
+        os.replace(tmp, filename)
+
+        print("sucessfully sorted %s" % name)
+
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate (and sort) the type definitions")
+    parser.add_argument(
+        "types_dir",
+        nargs="?",
+        default=DEFAULT_TYPES_DIR,
+        help="Directory with %s (default = types/ of act-bootstrap)" % ", ".join(
+            (OBJECT_TYPES, FACT_TYPES, META_FACT_TYPES)))
+    parser.add_argument(
+        "--sort",
+        action="store_true",
+        help="Write the definitions in canonical order (sorted by name, with sorted keys)")
+    args = parser.parse_args()
+
+    if args.sort and not sort_files(args.types_dir):
+        sys.exit(1)
+
+    try:
+        catalogue = load_dir(args.types_dir)
+    except CatalogueError as e:
+        for problem in e.problems:
+            print(problem)
+        sys.exit(1)
+
+    for problem in catalogue.undefined:
+        print(problem)
+
+    print("%d object types, %d fact types, %d meta fact types" % (
+        len(catalogue.object_types), len(catalogue.fact_types), len(catalogue.meta_fact_types)))
+
+    sys.exit(1 if catalogue.undefined else 0)
@@ -0,0 +1,151 @@
+""" Checkpoints of entities whose facts are committed, for resuming failed imports """
+
+import json
+import os
+import threading
+from logging import info, warning
+
+DEFAULT_CHECKPOINT_DIR = os.path.expanduser("~/.cache/act-bootstrap/checkpoints")
+
+VERSION = 1
+
+
+def add_arguments(parser):
+    """ Add checkpoint arguments to parser """
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip entities committed before the previous run failed")
+    parser.add_argument(
+        "--checkpoint",
+        help="Checkpoint file (default = <importer>.jsonl in %s)" % DEFAULT_CHECKPOINT_DIR)
+
+
+class Checkpoint(object):
+    """
+    Keys of entities (e.g. rows or groups) whose facts are committed.
+
+    The file is a log with one key per line, appended each time the fact
+    submitter has sent a batch, so a process that dies loses at most the
+    entities of the last batch. An entity is marked when all its facts are
+    submitted, and is committed by the next flush of the submitter (see
+    prepare() and commit()), unless one of its facts failed. The file is
+    removed when the import completes.
+
+    The facts of an entity are the facts submitted by the same thread
+    between done() and mark(), recorded by the submitter with record().
+    """
+
+    def __init__(self, filename, instance, resume=False):
+        directory = os.path.dirname(filename)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.filename = filename
+        self.instance = instance
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.marked = []
+        self.local = threading.local()
+
+        if resume and os.path.isfile(filename):
+            self.completed = self.load()
+            info("Resuming from checkpoint %s, %d entities committed" % (filename, len(self.completed)))
+        elif resume:
+            info("No checkpoint to resume from: %s" % filename)
+
+        self.f = open(filename, "w")
+        self.f.write(json.dumps({"version": VERSION, "instance": instance}) + "\n")
+
+        # Keep the loaded keys, so the checkpoint still covers them if this run fails too
+        for key in sorted(self.completed):
+            self.f.write(json.dumps(key) + "\n")
+        self.f.flush()
+
+    def load(self):
+        """ Keys committed in the previous run, if it was against the same instance """
+        completed = set()
+
+        try:
+            with open(self.filename) as f:
+                header = json.loads(f.readline())
+
+                if header.get("version") != VERSION or header.get("instance") != self.instance:
+                    warning("Ignoring checkpoint for another instance or version: %s" % self.filename)
+                    return completed
+
+                for line in f:
+                    try:
+                        completed.add(json.loads(line))
+                    except ValueError:
+                        break  # Partially written last line
+        except (OSError, ValueError):
+            pass
+
+        return completed
+
+    def done(self, key):
+        """
+        True if the entity was committed in the previous run. Otherwise, the
+        facts submitted by this thread are recorded for the entity until it
+        is marked.
+        """
+        if key in self.completed:
+            return True
+
+        self.local.facts = []
+        return False
+
+    def record(self, fact_key):
+        """ Record fact for the entity this thread is submitting, if any """
+        facts = getattr(self.local, "facts", None)
+
+        if facts is not None:
+            facts.append(fact_key)
+
+    def mark(self, key):
+        """ Mark entity as submitted, after all its facts are submitted """
+        facts = getattr(self.local, "facts", None) or []
+        self.local.facts = None
+
+        with self.lock:
+            self.marked.append((key, facts))
+
+    def prepare(self):
+        """ Take the marked entities, when the submitter takes its batch of facts """
+        with self.lock:
+            (marked, self.marked) = (self.marked, [])
+        return marked
+
+    def commit(self, marked, failed=frozenset()):
+        """
+        Record entities from prepare(), once the batch and all batches before
+        it have been sent. Entities with facts in failed (keys of facts that
+        were not added) are left uncommitted, so they are retried on resume.
+        """
+        committed = [key for (key, facts) in marked if failed.isdisjoint(facts)]
+
+        if len(committed) < len(marked):
+            warning("Not committing %d entities with failed facts" % (len(marked) - len(committed)))
+
+        if not committed:
+            return
+
+        with self.lock:
+            for key in committed:
+                self.completed.add(key)
+                self.f.write(json.dumps(key) + "\n")
+            self.f.flush()
+
+    def finish(self):
+        """ Remove the checkpoint, the import has completed """
+        with self.lock:
+            self.f.close()
+            os.remove(self.filename)
+
+
+def from_args(args, name, client):
+    """ Open the checkpoint for importer name, given on the command line """
+    filename = args.checkpoint or os.path.join(DEFAULT_CHECKPOINT_DIR, name + ".jsonl")
+    return Checkpoint(filename, client.config.act_baseurl, args.resume)
@@ -0,0 +1,102 @@
+""" Country code index compiled from the geonames countryInfo.txt """
+
+import csv
+import functools
+import json
+import os
+import tempfile
+from logging import info
+
+import httpcache
+
+COUNTRY_INFO_URL = "http://download.geonames.org/export/dump/countryInfo.txt"
+
+# Bump when the layout of the compiled index changes
+INDEX_VERSION = 2
+INDEX_FILENAME = "countries.json"
+
+# Code columns in countryInfo.txt, in order of preference when a code
+# is valid in more than one of them
+CODE_COLUMNS = (("iso", 0), ("iso3", 1), ("fips", 3))
+NAME_COLUMN = 4
+
+
+def compile_index(text):
+    """ Map each country code to (name, source), where source is iso, iso3 or fips """
+    codes = {}
+
+    for row in csv.reader(
+            [line for line in text.splitlines() if line and line[0] != '#'],
+            delimiter='\t'):
+        for (source, column) in CODE_COLUMNS:
+            if row[column]:
+                codes.setdefault(source, {})[row[column]] = row[NAME_COLUMN]
+
+    index = {}
+
+    for (source, _) in reversed(CODE_COLUMNS):
+        for (code, name) in codes.get(source, {}).items():
+            index[code] = (name, source)
+
+    return index
+
+
+class CountryIndex(object):
+    """ Lookup of country codes in all code columns at once """
+
+    def __init__(self, index):
+        self.index = index
+
+    def lookup(self, code):
+        """ Return (name, source) for code, or (None, None) if it is unknown """
+        return self.index.get(code, (None, None))
+
+
+def load_compiled(filename, body_version):
+    """ Load compiled index from filename, or None if it is missing or compiled from another body """
+    try:
+        with open(filename) as f:
+            compiled = json.load(f)
+        if compiled["version"] == INDEX_VERSION and compiled["body"] == body_version:
+            return CountryIndex({code: tuple(entry) for (code, entry) in compiled["index"].items()})
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return None
+
+
+def save_compiled(filename, body_version, index):
+    """ Write compiled index to filename """
+    directory = os.path.dirname(filename) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    (fd, tmp) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"version": INDEX_VERSION, "body": body_version, "index": index}, f, separators=(",", ":"))
+    os.replace(tmp, filename)
+
+
+def country_index(filename=None, url=COUNTRY_INFO_URL):
+    """
+    Get country index, revalidating countryInfo.txt through the HTTP cache.
+    The index is stored next to the HTTP cache unless filename is given.
+    It is keyed on the version of the cached countryInfo.txt, so the text
+    is only read when the upstream file has changed.
+    """
+    filename = filename or os.path.join(httpcache.cache_dir(), INDEX_FILENAME)
+
+    with httpcache.open_url(url, verify=False) as f:
+        # A new response is only stored in the cache once it is read
+        if not isinstance(f, httpcache.CachingReader):
+            index = load_compiled(filename, httpcache.body_version(url))
+            if index is not None:
+                return index
+
+        text = b"".join(iter(functools.partial(f.read, 65536), b"")).decode("utf8")
+
+    info("Compiling country index: %s" % filename)
+    index = compile_index(text)
+    save_compiled(filename, httpcache.body_version(url), index)
+
+    return CountryIndex(index)
@@ -0,0 +1,100 @@
+""" Local store of facts already added to the platform """
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+DEFAULT_FACT_STORE = os.path.expanduser("~/.cache/act-bootstrap/facts.db")
+
+
+def add_arguments(parser):
+    """ Add fact store arguments to parser """
+    parser.add_argument(
+        "--fact-store",
+        dest="fact_store",
+        default=DEFAULT_FACT_STORE,
+        help="Store of facts already added (default = %s)" % DEFAULT_FACT_STORE)
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Add all facts, including facts found in the fact store")
+
+
+def object_key(obj):
+    """ type/value of object, or empty string if the fact has no such object """
+    if not obj:
+        return ""
+
+    return "{}/{}".format(obj.type.name, obj.value)
+
+
+def fact_key(fact):
+    """
+    Key of fact: (type, source, destination, digest), where the digest
+    covers the full fact (including value and direction)
+    """
+    digest = hashlib.sha256(
+        "{}\n{}".format(fact, fact.value).encode("utf8")).hexdigest()
+
+    return (
+        fact.type.name,
+        object_key(fact.source_object),
+        object_key(fact.destination_object),
+        digest)
+
+
+class FactStore(object):
+    """
+    SQLite store of fact keys already added to an ACT instance. Facts are
+    always recorded, but only skipped when full is False.
+    """
+
+    def __init__(self, filename, instance, full=False):
+        directory = os.path.dirname(filename)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.instance = instance
+        self.full = full
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS facts (
+                instance TEXT,
+                type TEXT,
+                source TEXT,
+                destination TEXT,
+                digest TEXT,
+                PRIMARY KEY (instance, type, source, destination, digest))""")
+
+    def seen(self, key):
+        """ Return True if the fact should be skipped """
+        if self.full:
+            return False
+
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM facts WHERE instance=? AND type=? AND source=? AND destination=? AND digest=?",
+                (self.instance,) + key).fetchone() is not None
+
+    def add(self, key):
+        """ Record that the fact has been added """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO facts VALUES (?, ?, ?, ?, ?)",
+                (self.instance,) + key)
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def from_args(args, client):
+    """ Open the fact store given on the command line for the client ACT instance """
+    return FactStore(args.fact_store, client.config.act_baseurl, args.full)
@@ -3,20 +3,49 @@
 """ FireEye Carbanak facts """
 
 import argparse
-import io
+import collections
+import functools
 import ipaddress
+import json
+import os
 import re
+import threading
+from logging import info
 
-import pyexcel_xlsx
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 import act
 from act.fact import fact_chain
-from act.helpers import handle_fact
+import catalogue
+import checkpoint
+import factstore
+import hashlookup
+import httpcache
+import metrics
+import workers
+import xlsxstream
+from submit import FactSubmitter
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+CARBANAK_REPORT_URL = "https://www.fireeye.com/content/dam/fireeye-www/blog/pdfs/carbanak-report.xlsx"
+
+# Columns of the carbanak report. Other reports with md5, campaign and
+# c2 columns can be imported with --report and --report-config.
+CARBANAK_REPORT_COLUMNS = {
+    "sheet": "Sheet1",
+    "header_rows": 1,
+    "columns": {
+        "md5": "A",
+        "campaign": "D",
+        "c2": "E:",
+    },
+}
+
+# Number of resolved fact chains to keep (the most recently used)
+CHAIN_CACHE_SIZE = 4096
+
 
 def is_ip(addr):
     try:
@@ -27,148 +56,273 @@ def is_ip(addr):
     return False
 
 
-def parseargs():
+def parseargs(argv=None):
     """ Parse arguments """
     parser = argparse.ArgumentParser(description='FireEye Carbanak Facts')
     parser.add_argument('--userid', dest='user_id', help="User ID")
     parser.add_argument('--act-baseurl', dest='act_baseurl', help='ACT API URI')
-    parser.add_argument('--md5-lookup', required=True, help='ACT API URI')
+    parser.add_argument('--md5-lookup', required=True, help='File with md5,sha256 per line, or compiled lookup file')
     parser.add_argument("--logfile", dest="log_file", help="Log to file (default = stdout)")
     parser.add_argument("--loglevel", default="info", help="Loglevel (default = info)")
-    return parser.parse_args()
+    parser.add_argument(
+        "--report",
+        default=CARBANAK_REPORT_URL,
+        help="Report (xlsx) url or filename (default = %s)" % CARBANAK_REPORT_URL)
+    parser.add_argument(
+        "--report-config",
+        help="Sheet name, header rows and columns of report (json), default is the carbanak report")
+    workers.add_arguments(parser)
+    factstore.add_arguments(parser)
+    httpcache.add_arguments(parser)
+    checkpoint.add_arguments(parser)
+    catalogue.add_arguments(parser)
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def get_xlsx_report(report, config):
+    """
+    Yield rows from excel report (url or filename), mapped to dicts
+    as given by config (see xlsxstream.iter_mapped_rows)
+    """
+    if os.path.isfile(report):
+        yield from xlsxstream.iter_mapped_rows(report, config)
+        return
 
+    with httpcache.open_url(report, verify=False) as f:
+        yield from xlsxstream.iter_mapped_rows(f, config)
 
-def get_xlsx_report(url, sheet_name):
-    """ Download and parse excel report """
-    r = requests.get(url, verify=False)
-    data = pyexcel_xlsx.get_data(io.BytesIO(r.content))
-    return data[sheet_name]
+
+def load_columns(filename):
+    """ Load report config (json) with sheet name, header rows and columns """
+    if not filename:
+        return CARBANAK_REPORT_COLUMNS
+
+    with open(filename) as f:
+        return json.load(f)
 
 
 def get_md5_lookup(filename):
     """
-    Read file with md5,sha256
+    Open md5 -> sha256 lookup from file with md5,sha256 (compiled on first
+    use) or from a lookup file compiled by hashlookup.py
     """
-    lookup = {}
+    return hashlookup.open_lookup(filename)
 
-    with open(filename) as f:
-        for row in f:
-            (md5, sha256) = row.strip().split(",")
-            lookup[md5] = sha256
 
-    return lookup
-
-
-def carbanak_report(client, md5_lookup):
+def carbanak_report(submitter, md5_lookup, worker_count=1, report=CARBANAK_REPORT_URL,
+                    config=CARBANAK_REPORT_COLUMNS, progress=None):
     """
     Download and parse carbanak report
     Add facts for md5, sha256, c2 and campaigns
+    Rows committed before the previous run failed are skipped with progress (checkpoint)
     """
-    for row in get_xlsx_report(
-            "https://www.fireeye.com/content/dam/fireeye-www/blog/pdfs/carbanak-report.xlsx",
-            "Sheet1")[1:]:  # First row is header
+    chains = ChainCache(submitter)
 
-        md5 = row[0]
-        campaign = row[3]
-        c2_list = row[4:]
-        sha256 = md5_lookup.get(md5)
+    workers.run(
+        functools.partial(report_row, chains, md5_lookup, progress),
+        enumerate(get_xlsx_report(report, config)),
+        worker_count)
 
-        if not md5:
-            continue
+    info("Chains resolved from cache: %d" % chains.hits)
+    metrics.inc("chain_cache_hits_total", chains.hits)
 
-        if sha256:
-            content = sha256
-        else:
-            content = "*"  # Unknown
 
-        chain = []
+class ChainCache(object):
+    """
+    The size most recently resolved fact chains. Rows of a report mostly
+    share campaigns and infrastructure, so repeated chains are resolved
+    here instead of being submitted again. Other repeated facts are skipped
+    by the submitter.
+    """
+
+    def __init__(self, submitter, size=CHAIN_CACHE_SIZE):
+        self.submitter = submitter
+        self.client = submitter.client
+        self.size = size
+        self.lock = threading.Lock()
+        self.chains = collections.OrderedDict()  # keys of facts in chain -> destination (type, value) of each fact
+        self.hits = 0
+
+    def submit(self, fact):
+        """ Submit fact (the submitter skips facts that are recently submitted) """
+        self.submitter.submit(fact)
+
+    def resolve(self, *facts):
+        """
+        Replace placeholders in chain of facts and submit the facts, unless
+        the same chain is already resolved in this run. Returns list of
+        (type, value) of the destination object of each fact in the chain.
+        """
+        key = tuple(factstore.fact_key(fact) for fact in facts)
 
-        if content != "*":
-            handle_fact(client.fact("represents")
-                        .source("hash", md5)
-                        .destination("content", content))
+        with self.lock:
+            if key in self.chains:
+                self.hits += 1
+                self.chains.move_to_end(key)
+                return self.chains[key]
 
-        if campaign and not campaign == "NA" and isinstance(campaign, str):
-            chain = []
+            chain = fact_chain(*facts)
 
-            # Create chain
-            # (hash)? -represents> (content) -observedIn> (incident) -attributedTo-> (campaign)
+            # The facts are updated in place once they are added, so read them before submitting
+            destinations = self.chains[key] = [
+                (fact.destination_object.type.name, fact.destination_object.value)
+                for fact in chain]
 
-            if content == "*":  # start at md5, since content is unknown
-                chain.append(client.fact("represents")
-                             .source("hash", md5)
-                             .destination("content", "*"))
+            # Placeholders are derived from the chain, so an evicted chain resolves to the same facts again
+            if len(self.chains) > self.size:
+                self.chains.popitem(last=False)
 
-            # continue with content, which can either be "*" or sha256
-            chain.append(client.fact("observedIn", "incident")
-                         # content sha256 if we have that, otherwise "*"
-                         .source("content", content)
-                         .destination("incident", "*"))
+        for fact in chain:
+            self.submit(fact)
 
-            chain.append(client.fact("attributedTo")
-                         .source("incident", "*")
-                         .destination("campaign", campaign))
+        return destinations
 
-            for fact in fact_chain(*chain):  # Find content value (placeholder)
-                handle_fact(fact)
 
-                # Replace content with placeholder object
-                if content == "*" and fact.destination_object.type.name == "content":
-                    content = fact.destination_object.value
+def report_row(chains, md5_lookup, progress, entry):
+    """ Add facts for (index, row), unless the row is already committed """
+    (index, row) = entry
+    key = "row/%d" % index
 
-        for c2 in c2_list:
-            c2_no_port = re.sub(r':.*$', "", c2)
-            port = re.sub(r'^.*:', "", c2)
+    if progress and progress.done(key):
+        return
 
-            chain = []
+    metrics.inc("entries_total", source="carbanak", object_type="row")
+    carbanak_row(chains, md5_lookup, row)
 
-            # Create chain
-            # (hash)? -represents> (content) -connectsTo> (uri) <-componentOf- (uri|fqdn)
+    if progress:
+        progress.mark(key)
+
+
+def carbanak_row(chains, md5_lookup, row):
+    """ Add facts for one row of the carbanak report """
+    md5 = row["md5"]
+    campaign = row.get("campaign")
+    c2_list = row.get("c2", [])
+    sha256 = md5_lookup.get(md5)
+
+    if not md5:
+        return
+
+    if sha256:
+        content = sha256
+    else:
+        content = "*"  # Unknown
+
+    chain = []
+
+    if content != "*":
+        chains.submit(chains.client.fact("represents")
+                      .source("hash", md5)
+                      .destination("content", content))
+
+    if campaign and not campaign == "NA" and isinstance(campaign, str):
+        chain = []
+
+        # Create chain
+        # (hash)? -represents> (content) -observedIn> (incident) -attributedTo-> (campaign)
+
+        if content == "*":  # start at md5, since content is unknown
+            chain.append(chains.client.fact("represents")
+                         .source("hash", md5)
+                         .destination("content", "*"))
+
+        # continue with content, which can either be "*" or sha256
+        chain.append(chains.client.fact("observedIn", "incident")
+                     # content sha256 if we have that, otherwise "*"
+                     .source("content", content)
+                     .destination("incident", "*"))
+
+        chain.append(chains.client.fact("attributedTo")
+                     .source("incident", "*")
+                     .destination("campaign", campaign))
+
+        for (object_type, value) in chains.resolve(*chain):  # Find content value (placeholder)
+            # Replace content with placeholder object
+            if content == "*" and object_type == "content":
+                content = value
+
+    for c2 in c2_list:
+        c2_no_port = re.sub(r':.*$', "", c2)
+        port = re.sub(r'^.*:', "", c2)
+
+        chain = []
 
-            if content == "*":  # Start at md5
-                chain.append(client.fact("represents")
-                             .source("hash", md5)
-                             .destination("content", "*"))
+        # Create chain
+        # (hash)? -represents> (content) -connectsTo> (uri) <-componentOf- (uri|fqdn)
 
-            # continue with content, which can either be "*" or sha256
-            chain.append(client.fact("connectsTo")
-                         .source("content", content)
-                         .destination("uri", "*"))
+        if content == "*":  # Start at md5
+            chain.append(chains.client.fact("represents")
+                         .source("hash", md5)
+                         .destination("content", "*"))
 
-            object_type = "ipv4" if is_ip(c2_no_port) else "fqdn"
+        # continue with content, which can either be "*" or sha256
+        chain.append(chains.client.fact("connectsTo")
+                     .source("content", content)
+                     .destination("uri", "*"))
 
-            # Add componentOf (either ipv4 or fqdn)
-            chain.append(client.fact("componentOf")
-                         .source(object_type, c2_no_port)
-                         .destination("uri", "*"))
+        object_type = "ipv4" if is_ip(c2_no_port) else "fqdn"
 
-            for fact in fact_chain(*chain):  # Find content value (placeholder)
-                handle_fact(fact)
+        # Add componentOf (either ipv4 or fqdn)
+        chain.append(chains.client.fact("componentOf")
+                     .source(object_type, c2_no_port)
+                     .destination("uri", "*"))
 
-                # Replace content with placeholder object if this was previously unknown
-                if content == "*" and fact.destination_object.type.name == "content":
-                    content = fact.destination_object.value
+        for (object_type, value) in chains.resolve(*chain):  # Find content value (placeholder)
+            # Replace content with placeholder object if this was previously unknown
+            if content == "*" and object_type == "content":
+                content = value
 
-                # Add port to uri placeholder
-                if port and fact.destination_object.type.name == "uri":
-                    handle_fact(client.fact("port", str(port))
-                                .source("uri", fact.destination_object.value))
+            # Add port to uri placeholder
+            if port and object_type == "uri":
+                chains.submit(chains.client.fact("port", str(port))
+                              .source("uri", value))
 
-        if content != "*":
-            handle_fact(client.fact("classifiedAs")
-                        .source("content", content)
-                        .destination("tool", "carbanak"))
+    if content != "*":
+        chains.submit(chains.client.fact("classifiedAs")
+                      .source("content", content)
+                      .destination("tool", "carbanak"))
 
 
 if __name__ == '__main__':
     args = parseargs()
 
-    carbanak_report(
-        act.Act(
-            args.act_baseurl,
-            args.user_id,
-            args.loglevel,
-            args.log_file,
-            "fireye-carbanak"),
-        get_md5_lookup(args.md5_lookup),
-    )
+    client = act.Act(
+        args.act_baseurl,
+        args.user_id,
+        args.loglevel,
+        args.log_file,
+        "fireye-carbanak")
+
+    httpcache.configure(args)
+    metrics.configure(args)
+
+    submitter = FactSubmitter(
+        client,
+        session=workers.session_from_args(args),
+        store=factstore.from_args(args, client),
+        fact_check=catalogue.from_args(args))
+
+    progress = checkpoint.from_args(args, "fireeye-carbanak", client)
+    submitter.add_checkpoint(progress)
+
+    with metrics.phase("md5_lookup_load"):
+        md5_lookup = get_md5_lookup(args.md5_lookup)
+
+    # The report is fetched while it is parsed, so this includes the fetch
+    with metrics.phase("carbanak_insert"):
+        carbanak_report(
+            submitter,
+            md5_lookup,
+            args.workers,
+            args.report,
+            load_columns(args.report_config),
+            progress,
+        )
+
+    # Send remaining facts
+    with metrics.phase("submit_flush"):
+        submitter.close()
+    progress.finish()
+
+    metrics.finish(args)
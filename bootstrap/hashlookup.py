@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+Disk backed md5 -> sha256 lookup
+
+The lookup is compiled once from a CSV file (md5,sha256 per line) to a
+file of fixed width binary records sorted by md5, which is memory mapped
+and searched with binary search. Only the pages that are touched by a
+lookup are read into memory.
+"""
+
+import argparse
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+from logging import info, warning
+
+DEFAULT_INDEX_DIR = os.path.expanduser("~/.cache/act-bootstrap/hashlookup")
+
+MAGIC = b"ACTMD5\x00\x01"
+HEADER = struct.Struct("!8sQ")  # magic, number of records
+MD5_SIZE = 16
+SHA256_SIZE = 32
+RECORD_SIZE = MD5_SIZE + SHA256_SIZE
+
+# Number of records sorted in memory at a time when compiling
+RUN_SIZE = 1000000
+
+
+def parse_csv(filename):
+    """ Yield binary (md5 + sha256) records from CSV file """
+    with open(filename) as f:
+        for (lineno, row) in enumerate(f, 1):
+            row = row.strip()
+            if not row:
+                continue
+
+            try:
+                (md5, sha256) = row.split(",")
+                record = bytes.fromhex(md5.strip()) + bytes.fromhex(sha256.strip())
+            except ValueError:
+                record = b""
+
+            if len(record) != RECORD_SIZE:
+                warning("Invalid md5,sha256 on line %d in %s" % (lineno, filename))
+                continue
+
+            yield record
+
+
+def md5_key(record):
+    return record[:MD5_SIZE]
+
+
+def sorted_runs(records, directory):
+    """
+    Sort records by md5 in runs of RUN_SIZE, return list of temporary files
+    with each run. The sort is stable, so duplicate md5s are in file order.
+    """
+    runs = []
+    run = []
+
+    def flush():
+        f = tempfile.TemporaryFile(dir=directory)
+        f.write(b"".join(sorted(run, key=md5_key)))
+        f.seek(0)
+        runs.append(f)
+        run.clear()
+
+    for record in records:
+        run.append(record)
+        if len(run) >= RUN_SIZE:
+            flush()
+
+    if run or not runs:
+        flush()
+
+    return runs
+
+
+def read_run(f):
+    """ Yield records from sorted run """
+    while True:
+        record = f.read(RECORD_SIZE)
+        if not record:
+            return
+        yield record
+
+
+def compile_lookup(csv_filename, filename):
+    """ Compile CSV file (md5,sha256) to binary lookup file """
+    info("Compiling md5 lookup %s -> %s" % (csv_filename, filename))
+
+    directory = os.path.dirname(filename) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    runs = sorted_runs(parse_csv(csv_filename), directory)
+
+    (fd, tmp) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "wb") as out:
+        out.write(HEADER.pack(MAGIC, 0))
+
+        count = 0
+        previous = None
+
+        # The merge is stable (runs are in file order), so the last sha256 of
+        # duplicate md5s is kept, as when the CSV file was read into a dict
+        for record in heapq.merge(*[read_run(f) for f in runs], key=md5_key):
+            if previous is not None and md5_key(previous) != md5_key(record):
+                out.write(previous)
+                count += 1
+            previous = record
+
+        if previous is not None:
+            out.write(previous)
+            count += 1
+
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, count))
+
+    for f in runs:
+        f.close()
+
+    os.replace(tmp, filename)
+
+
+def is_compiled(filename):
+    """ True if filename is a compiled lookup file """
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def index_filename(csv_filename, directory=DEFAULT_INDEX_DIR):
+    """ Name of compiled lookup file for csv_filename """
+    key = hashlib.sha256(os.path.abspath(csv_filename).encode("utf8")).hexdigest()
+    return os.path.join(directory, key + ".md5")
+
+
+class HashLookup(object):
+    """ Memory mapped md5 -> sha256 lookup, with the same get() as a dict """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.count) = HEADER.unpack_from(self.mmap)
+
+        if magic != MAGIC or len(self.mmap) != HEADER.size + self.count * RECORD_SIZE:
+            raise ValueError("Not a valid md5 lookup file: %s" % filename)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, md5, default=None):
+        """ Return sha256 (hex) of md5 (hex), or default if md5 is unknown """
+        try:
+            key = bytes.fromhex(md5)
+        except (TypeError, ValueError):
+            return default
+
+        (low, high) = (0, self.count)
+
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD_SIZE
+            current = self.mmap[offset:offset + MD5_SIZE]
+
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return self.mmap[offset + MD5_SIZE:offset + RECORD_SIZE].hex()
+
+        return default
+
+    def close(self):
+        self.mmap.close()
+
+
+def open_lookup(filename, directory=DEFAULT_INDEX_DIR):
+    """
+    Open md5 lookup. filename is either a compiled lookup file, or a CSV
+    file that is compiled to directory the first time it is used, and
+    again whenever it has been modified.
+    """
+    if is_compiled(filename):
+        return HashLookup(filename)
+
+    compiled = index_filename(filename, directory)
+
+    if not os.path.isfile(compiled) or os.path.getmtime(compiled) < os.path.getmtime(filename):
+        compile_lookup(filename, compiled)
+
+    return HashLookup(compiled)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile md5,sha256 CSV file to binary lookup file")
+    parser.add_argument("csv", help="CSV file with md5,sha256 per line")
+    parser.add_argument("output", help="Compiled lookup file")
+    args = parser.parse_args()
+
+    compile_lookup(args.csv, args.output)
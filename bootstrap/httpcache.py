@@ -0,0 +1,360 @@
+""" On-disk HTTP cache for upstream feeds, using conditional requests """
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+from logging import info, warning
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import metrics
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/act-bootstrap/http")
+
+
+class OfflineError(Exception):
+    """ Response is not in the cache, and --offline does not allow it to be fetched """
+
+
+def add_arguments(parser):
+    """ Add HTTP cache arguments to parser """
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        default=DEFAULT_CACHE_DIR,
+        help="HTTP cache directory (default = %s)" % DEFAULT_CACHE_DIR)
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        type=int,
+        default=0,
+        help="Seconds to use cached responses without revalidating them (default = 0)")
+    parser.add_argument(
+        "--cache-max-size",
+        dest="cache_max_size",
+        type=int,
+        default=1024,
+        help="Maximum size of the HTTP cache in MB, least recently used entries are evicted first (default = 1024)")
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use cached responses, do not access the network")
+
+
+class HTTPCache(object):
+    """
+    Cache of GET responses. Each entry is stored as <key>.body and
+    <key>.json (url, headers and time of the last validation).
+
+    Entries older than ttl seconds are revalidated with If-None-Match and
+    If-Modified-Since, and a 304 response is served from disk. In offline
+    mode only cached entries are used, regardless of age.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, ttl=0, max_size=1024, offline=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size * 1024 * 1024
+        self.offline = offline
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+
+    def path(self, url, suffix):
+        key = hashlib.sha256(url.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, key + suffix)
+
+    def load_meta(self, url):
+        """ Return metadata for url, or None if it is not cached """
+        try:
+            with open(self.path(url, ".json")) as f:
+                meta = json.load(f)
+            if not os.path.isfile(self.path(url, ".body")):
+                return None
+        except (OSError, ValueError):
+            return None
+
+        # Access time is used to find the least recently used entries
+        os.utime(self.path(url, ".json"))
+
+        return meta
+
+    def load(self, url):
+        """ Return (metadata, body) for url, or (None, None) if it is not cached """
+        meta = self.load_meta(url)
+
+        if meta is None:
+            return (None, None)
+
+        try:
+            with open(self.path(url, ".body"), "rb") as f:
+                return (meta, f.read())
+        except OSError:
+            return (None, None)
+
+    def body_version(self, url, params=None):
+        """
+        Modification time (ns) of the cached body of url, or None if it is not
+        cached. It only changes when a new body is stored, not when the entry
+        is revalidated, so data derived from the body can be keyed on it.
+        """
+        url = requests.Request("GET", url, params=params).prepare().url
+        try:
+            return os.stat(self.path(url, ".body")).st_mtime_ns
+        except OSError:
+            return None
+
+    def write(self, filename, data):
+        """ Write file atomically, so concurrent readers never see partial entries """
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+    def store(self, url, meta, body=None):
+        if body is not None:
+            self.write(self.path(url, ".body"), body)
+        self.write(self.path(url, ".json"), json.dumps(meta).encode("utf8"))
+
+    def evict(self):
+        """ Remove least recently used entries until the cache is below max_size """
+        with self.lock:
+            entries = []
+            for filename in os.listdir(self.directory):
+                if not filename.endswith(".json"):
+                    continue
+                meta_file = os.path.join(self.directory, filename)
+                body_file = meta_file[:-len(".json")] + ".body"
+                try:
+                    size = os.path.getsize(meta_file) + os.path.getsize(body_file)
+                    entries.append((os.path.getmtime(meta_file), size, meta_file, body_file))
+                except OSError:
+                    continue
+
+            total = sum(size for (_, size, _, _) in entries)
+
+            for (_, size, meta_file, body_file) in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for filename in (meta_file, body_file):
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+                total -= size
+
+    def fresh(self, meta):
+        """ True if entry can be used without revalidating it """
+        return self.offline or (meta is not None and time.time() - meta["validated"] < self.ttl)
+
+    def conditional_headers(self, meta, headers):
+        """ Request headers, with validators from the cached entry """
+        headers = dict(headers)
+
+        if meta and meta["headers"].get("ETag"):
+            headers["If-None-Match"] = meta["headers"]["ETag"]
+        if meta and meta["headers"].get("Last-Modified"):
+            headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+
+        return headers
+
+    def fetch(self, url, meta, **kwargs):
+        """ Conditional GET of url, recording upstream latency """
+        headers = self.conditional_headers(meta, kwargs.pop("headers", {}))
+        host = urllib.parse.urlparse(url).netloc
+
+        try:
+            with metrics.timer("upstream_fetch_seconds", host=host):
+                r = self.session.get(url, headers=headers, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.inc("upstream_requests_total", host=host, status="error")
+            raise
+
+        metrics.inc("upstream_requests_total", host=host, status=r.status_code)
+
+        return r
+
+    def revalidated(self, url, meta):
+        info("Not modified, using cached response: {}".format(url))
+        metrics.inc("http_cache_total", result="revalidated")
+        meta["validated"] = time.time()
+        self.store(url, meta)
+
+    def get(self, url, params=None, **kwargs):
+        """
+        GET url, using the cache where possible. Accepts the same
+        arguments as requests.get() and returns a requests.Response.
+        """
+        url = requests.Request("GET", url, params=params).prepare().url
+        (meta, body) = self.load(url)
+
+        if self.offline and meta is None:
+            raise OfflineError("Not in cache: {}".format(url))
+
+        if self.fresh(meta):
+            metrics.inc("http_cache_total", result="hit")
+            return response(url, meta, body)
+
+        r = self.fetch(url, meta, **kwargs)
+
+        if r.status_code == 304 and meta:
+            self.revalidated(url, meta)
+            return response(url, meta, body)
+
+        if r.status_code != 200:
+            warning("Request failed, not cached: {}, {}".format(url, r.status_code))
+            return r
+
+        metrics.inc("http_cache_total", result="miss")
+        self.store(url, metadata(url, r), r.content)
+        self.evict()
+
+        return r
+
+    def open(self, url, params=None, **kwargs):
+        """
+        Like get(), but return a binary file object with the response
+        body. A new response is written to the cache while it is read,
+        so large documents are never held in memory.
+        """
+        url = requests.Request("GET", url, params=params).prepare().url
+        meta = self.load_meta(url)
+
+        if self.offline and meta is None:
+            raise OfflineError("Not in cache: {}".format(url))
+
+        if self.fresh(meta):
+            metrics.inc("http_cache_total", result="hit")
+            return open(self.path(url, ".body"), "rb")
+
+        r = self.fetch(url, meta, stream=True, **kwargs)
+
+        if r.status_code == 304 and meta:
+            r.close()
+            self.revalidated(url, meta)
+            return open(self.path(url, ".body"), "rb")
+
+        if r.status_code != 200:
+            warning("Request failed, not cached: {}, {}".format(url, r.status_code))
+            r.raise_for_status()
+            return io.BytesIO(r.content)
+
+        metrics.inc("http_cache_total", result="miss")
+        return CachingReader(self, url, r)
+
+
+class CachingReader(io.RawIOBase):
+    """
+    Read streamed response body, and store it in the cache when it has
+    been read to the end. Partially read bodies are discarded.
+    """
+
+    def __init__(self, cache, url, r):
+        io.RawIOBase.__init__(self)
+        self.cache = cache
+        self.url = url
+        self.response = r
+        (fd, self.tmp) = tempfile.mkstemp(dir=cache.directory)
+        self.f = os.fdopen(fd, "wb")
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.f.closed:
+            return b""
+
+        chunk = self.response.raw.read(None if size < 0 else size, decode_content=True)
+
+        if chunk:
+            self.f.write(chunk)
+        else:
+            self.f.close()
+            os.replace(self.tmp, self.cache.path(self.url, ".body"))
+            self.cache.store(self.url, metadata(self.url, self.response))
+            self.cache.evict()
+
+        return chunk
+
+    def readinto(self, b):
+        chunk = self.read(len(b))
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+            os.remove(self.tmp)
+        self.response.close()
+        io.RawIOBase.close(self)
+
+
+def metadata(url, r):
+    """ Cache metadata for response """
+    return {
+        "url": url,
+        "validated": time.time(),
+        "headers": {
+            name: r.headers[name]
+            for name in ("Content-Type", "ETag", "Last-Modified")
+            if name in r.headers},
+    }
+
+
+def response(url, meta, body):
+    """ Create requests.Response from cached entry """
+    r = requests.Response()
+    r.url = url
+    r.status_code = 200
+    r.headers = CaseInsensitiveDict(meta["headers"])
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    r._content = body
+    return r
+
+
+# Cache used by get(), replaced by configure()
+_cache = None
+
+
+def configure(args):
+    """ Set up the cache used by get() from command line arguments """
+    global _cache
+    _cache = HTTPCache(args.cache_dir, args.cache_ttl, args.cache_max_size, args.offline)
+    return _cache
+
+
+def open_url(url, params=None, **kwargs):
+    """ Cached GET, returning a file object with the response body """
+    global _cache
+    if _cache is None:
+        _cache = HTTPCache()
+    return _cache.open(url, params=params, **kwargs)
+
+
+def body_version(url, params=None):
+    """ Version of the cached body of url (see HTTPCache.body_version) """
+    global _cache
+    if _cache is None:
+        _cache = HTTPCache()
+    return _cache.body_version(url, params=params)
+
+
+def cache_dir():
+    """ Directory of the cache used by get() """
+    return _cache.directory if _cache else DEFAULT_CACHE_DIR
+
+
+def get(url, params=None, **kwargs):
+    """ Cached replacement for requests.get() """
+    global _cache
+    if _cache is None:
+        _cache = HTTPCache()
+    return _cache.get(url, params=params, **kwargs)
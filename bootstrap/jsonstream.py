@@ -0,0 +1,174 @@
+""" Incremental parsing of large JSON documents """
+
+import codecs
+import json
+
+CHUNK_SIZE = 65536
+WHITESPACE = " \t\n\r"
+
+# Characters that may continue a number (e.g. "1" in "1.5e-3")
+NUMBER_CHARS = "0123456789+-.eE"
+
+DECODER = json.JSONDecoder()
+
+
+class Reader(object):
+    """
+    Read JSON values one at a time from a text or binary (utf8) stream,
+    keeping only the current value in memory
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder("utf8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ Read more data into the buffer, return False at end of stream """
+        if self.eof:
+            return False
+
+        # Drop data that is already parsed
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+
+        while True:
+            # Read at least as much as is buffered, so large values are completed
+            # in a logarithmic number of attempts
+            data = self.f.read(max(self.chunk_size, len(self.buffer)))
+
+            if not data:
+                self.eof = True
+                text = self.utf8.decode(b"", final=True) if isinstance(data, bytes) else ""
+            elif isinstance(data, bytes):
+                # A chunk that ends inside a multi-byte character may decode to nothing
+                text = self.utf8.decode(data)
+            else:
+                text = data
+
+            if text or self.eof:
+                self.buffer += text
+                return bool(text)
+
+    def peek(self):
+        """ Return next non-whitespace character, or empty string at end of stream """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        """ Consume next non-whitespace character, which must be one of chars """
+        char = self.peek()
+
+        if not char or char not in chars:
+            raise json.JSONDecodeError(
+                "Expected one of %s" % ", ".join(chars), self.buffer, self.pos)
+
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ Decode next value """
+        self.peek()
+
+        while True:
+            try:
+                (value, end) = DECODER.raw_decode(self.buffer, self.pos)
+
+                # A number is truncated if it runs to the end of the buffer, even if
+                # it decodes (e.g. "1." decodes to 1, before the rest of "1.5" is read)
+                if self.eof or not self.truncated_number(end):
+                    self.pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self.fill()
+
+    def truncated_number(self, end):
+        """ True if the value ending at end is a number that may continue after the buffer """
+        if self.buffer[self.pos] not in NUMBER_CHARS:
+            return end == len(self.buffer)
+
+        while end < len(self.buffer) and self.buffer[end] in NUMBER_CHARS:
+            end += 1
+
+        return end == len(self.buffer)
+
+    def end(self):
+        """ Consume the rest of the stream, which must be whitespace """
+        if self.peek():
+            raise json.JSONDecodeError("Extra data", self.buffer, self.pos)
+
+    def array(self):
+        """ Yield each element of the next value, which must be an array """
+        self.expect("[")
+
+        if self.peek() == "]":
+            self.pos += 1
+            return
+
+        while True:
+            yield self.value()
+
+            if self.expect(",]") == "]":
+                return
+
+
+def iter_items(f):
+    """ Yield (key, value) for each member of the JSON object in f """
+    reader = Reader(f)
+    reader.expect("{")
+
+    if reader.peek() == "}":
+        reader.expect("}")
+        reader.end()
+        return
+
+    while True:
+        key = reader.value()
+        reader.expect(":")
+
+        yield (key, reader.value())
+
+        if reader.expect(",}") == "}":
+            reader.end()
+            return
+
+
+def iter_array(f, key):
+    """
+    Yield each element of the array at key in the JSON object in f.
+    Other members of the object are decoded and skipped.
+    """
+    reader = Reader(f)
+    reader.expect("{")
+
+    if reader.peek() == "}":
+        reader.expect("}")
+        reader.end()
+        return
+
+    while True:
+        name = reader.value()
+        reader.expect(":")
+
+        if name == key:
+            yield from reader.array()
+        else:
+            reader.value()
+
+        if reader.expect(",}") == "}":
+            reader.end()
+            return
@@ -0,0 +1,249 @@
+"""
+Metrics shared by all importers: counters, phase timers and latency
+histograms, written as json or Prometheus text format, and optional
+cProfile and tracemalloc capture
+"""
+
+import bisect
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from logging import info
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Number of allocation sites reported with --tracemalloc
+TRACEMALLOC_TOP = 20
+
+
+def add_arguments(parser):
+    """ Add metrics and profiling arguments to parser """
+    parser.add_argument(
+        "--metrics",
+        help="Write metrics to file when done")
+    parser.add_argument(
+        "--metrics-format",
+        dest="metrics_format",
+        choices=("json", "prometheus"),
+        default="json",
+        help="Format of --metrics (default = json)")
+    parser.add_argument(
+        "--profile",
+        help="Write cProfile statistics of all threads to file (pstats format)")
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Trace memory allocations, and add peak memory and the top allocation sites to the metrics")
+
+
+def labels_key(labels):
+    """ Sorted (label, value) pairs, with values as strings so that keys are ordered """
+    return tuple(sorted((label, str(value)) for (label, value) in labels.items()))
+
+
+class Histogram(object):
+    """ Cumulative count of observations per bucket, with count and sum """
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """ (upper bound, cumulative count) for each bucket, including +Inf """
+        total = 0
+        out = []
+        for (bound, count) in zip(BUCKETS, self.buckets):
+            total += count
+            out.append((bound, total))
+        out.append(("+Inf", self.count))
+        return out
+
+
+class Registry(object):
+    """ Thread safe counters, gauges and histograms, identified by name and labels """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """ Increment counter """
+        key = (name, labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set gauge """
+        with self.lock:
+            self.gauges[(name, labels_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        """ Add observation (seconds) to histogram """
+        key = (name, labels_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Observe the duration of the block in histogram name """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def phase(self, phase):
+        """ Time a phase of the import (e.g. fetch, parse, insert) """
+        return self.timer("phase_seconds", phase=phase)
+
+    def to_json(self):
+        """ Metrics as a json serializable dict """
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for ((name, labels), value) in sorted(self.counters.items())],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for ((name, labels), value) in sorted(self.gauges.items())],
+                "histograms": [
+                    {"name": name,
+                     "labels": dict(labels),
+                     "count": histogram.count,
+                     "sum": round(histogram.sum, 6),
+                     "buckets": {str(bound): count for (bound, count) in histogram.cumulative()}}
+                    for ((name, labels), histogram) in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self):
+        """ Metrics in Prometheus text format """
+        def series(name, labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return name
+            return "%s{%s}" % (name, ",".join(
+                '%s="%s"' % (label, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                for (label, value) in labels))
+
+        out = []
+
+        with self.lock:
+            for (kind, metrics) in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for (name, _) in metrics}):
+                    out.append("# TYPE %s %s" % (name, kind))
+                    for ((metric, labels), value) in sorted(metrics.items()):
+                        if metric == name:
+                            out.append("%s %s" % (series(name, labels), value))
+
+            for name in sorted({name for (name, _) in self.histograms}):
+                out.append("# TYPE %s histogram" % name)
+                for ((metric, labels), histogram) in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for (bound, count) in histogram.cumulative():
+                        out.append("%s %d" % (series(name + "_bucket", labels, [("le", bound)]), count))
+                    out.append("%s %s" % (series(name + "_sum", labels), round(histogram.sum, 6)))
+                    out.append("%s %d" % (series(name + "_count", labels), histogram.count))
+
+        return "\n".join(out) + "\n"
+
+
+# Registry shared by all modules of an importer (the metrics sink)
+registry = Registry()
+
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+phase = registry.phase
+
+_profiler = None
+
+# Profilers of the threads started after configure(), merged by finish()
+_thread_profilers = []
+_thread_profilers_lock = threading.Lock()
+
+
+def profile_thread(*_):
+    """
+    Profile function of new threads, which replaces itself with a profiler
+    of the thread. Before Python 3.12, a profiler only sees the thread that
+    enabled it, and the importers do most of their work in worker threads.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    with _thread_profilers_lock:
+        _thread_profilers.append(profiler)
+
+
+def configure(args):
+    """ Start profiling and memory tracing, as given on the command line """
+    global _profiler
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    if args.profile:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+        # From Python 3.12 a profiler sees all threads
+        if sys.version_info < (3, 12):
+            threading.setprofile(profile_thread)
+
+
+def finish(args):
+    """ Stop profiling and write metrics and profile, as given on the command line """
+    if _profiler:
+        _profiler.disable()
+        threading.setprofile(None)
+
+        stats = pstats.Stats(_profiler)
+        with _thread_profilers_lock:
+            for profiler in _thread_profilers:
+                stats.add(profiler)
+
+        stats.dump_stats(args.profile)
+        info("Wrote profile to %s (%d threads)" % (args.profile, len(_thread_profilers) + 1))
+
+    if args.tracemalloc and tracemalloc.is_tracing():
+        (current, peak) = tracemalloc.get_traced_memory()
+        registry.set("memory_traced_bytes", current)
+        registry.set("memory_traced_peak_bytes", peak)
+
+        # Leave out the allocations of the profiler itself
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+
+        for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+            frame = stat.traceback[0]
+            registry.set("memory_allocated_bytes", stat.size, site="%s:%d" % (frame.filename, frame.lineno))
+
+        tracemalloc.stop()
+
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            if args.metrics_format == "prometheus":
+                f.write(registry.to_prometheus())
+            else:
+                json.dump(registry.to_json(), f, indent=2)
+        info("Wrote metrics to %s" % args.metrics)
@@ -1,21 +1,70 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-from logging import error, warning
+import functools
+import re
+from logging import error, info, warning
 
-import requests
 import urllib3
 
 import act
+import aliases
+import catalogue
+from countries import country_index
+import factstore
+import httpcache
+import jsonstream
+import metrics
+import workers
+from submit import FactSubmitter
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-
-def parseargs():
+MISP_GALAXY_URL = "https://raw.githubusercontent.com/MISP/misp-galaxy/master/clusters/{}.json"
+MISP_THREAT_ACTOR_URL = MISP_GALAXY_URL.format("threat-actor")
+
+# Object type of the entries in each galaxy cluster
+CLUSTERS = {
+    "threat-actor": "threatActor",
+    "mitre-intrusion-set": "threatActor",
+    "backdoor": "tool",
+    "banker": "tool",
+    "botnet": "tool",
+    "exploit-kit": "tool",
+    "malpedia": "tool",
+    "mitre-malware": "tool",
+    "mitre-tool": "tool",
+    "rat": "tool",
+    "ransomware": "tool",
+    "stealer": "tool",
+    "tool": "tool",
+}
+
+# Facts for meta fields of entries, by object type of the entry:
+# (meta field, fact type, kind), where kind is one of
+#   alias     bidirectional fact between the entry and each value (see aliases.py)
+#   location  fact from the entry to the location of each country code
+MAPPINGS = {
+    "threatActor": [
+        ("synonyms", "threatActorAlias", "alias"),
+        ("country", "sourceGeography", "location"),
+    ],
+    "tool": [
+        ("synonyms", "toolAlias", "alias"),
+    ],
+}
+
+# Object types whose names (and aliases) are lower case, as in mitre-attack.py
+LOWER_CASE = {"tool"}
+
+# ATT&CK ID of entries in the mitre-* clusters, e.g. "APT1 - G0006"
+ATTACK_ID = re.compile(r" - [GS]\d+$")
+
+
+def parseargs(argv=None):
     """ Parse arguments """
     parser = argparse.ArgumentParser(
-        description='Get Threat Actors (MISP Galaxy)')
+        description='Get Threat Actors, tools and other galaxy clusters (MISP Galaxy)')
     parser.add_argument(
         '--userid',
         dest='user_id',
@@ -35,84 +84,116 @@ def parseargs():
         dest="log_level",
         default="info",
         help="Loglevel (default = info)")
+    parser.add_argument(
+        "--cluster",
+        dest="clusters",
+        action="append",
+        choices=sorted(CLUSTERS),
+        help="Galaxy cluster to import, may be repeated (default = threat-actor)")
+    parser.add_argument(
+        "--all-clusters",
+        action="store_true",
+        help="Import all supported galaxy clusters")
+    workers.add_arguments(parser)
+    factstore.add_arguments(parser)
+    httpcache.add_arguments(parser)
+    aliases.add_arguments(parser)
+    catalogue.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.all_clusters:
+        args.clusters = sorted(CLUSTERS)
+    elif not args.clusters:
+        args.clusters = ["threat-actor"]
+
+    return args
+
+
+def get_misp_threat_actors(url=MISP_THREAT_ACTOR_URL):
+    """
+    Yield threat actors from MISP galaxy cluster, parsed one at a time
+    while the cluster is downloaded
+    """
+    with httpcache.open_url(url, verify=False) as f:
+        yield from jsonstream.iter_array(f, "values")
+
 
-    return parser.parse_args()
+def get_cluster(cluster):
+    """ Yield (object type, entry) for each entry in galaxy cluster """
+    info("Fetching galaxy cluster %s" % cluster)
 
+    for entry in get_misp_threat_actors(MISP_GALAXY_URL.format(cluster)):
+        yield (CLUSTERS[cluster], entry)
 
-def get_misp_threat_actors():
-    url = "https://raw.githubusercontent.com/MISP/misp-galaxy/master/clusters/threat-actor.json"
-    r = requests.get(url, verify=False)
-    return r.json()
 
+def add_clusters(submitter, alias_graph, clusters, worker_count=1):
+    """
+    Add facts for all entries in clusters. The clusters are downloaded and
+    parsed concurrently, and the entries are added as they are parsed.
+    Aliases are added to alias_graph, and must be submitted from there.
+    """
+    with metrics.phase("countries_load"):
+        countries = country_index()
 
-def countrylist():
-    url = "http://download.geonames.org/export/dump/countryInfo.txt"
-    r = requests.get(url, verify=False)
+    workers.run(
+        functools.partial(add_entry, submitter, alias_graph, countries),
+        workers.merge((get_cluster(cluster) for cluster in clusters), maxsize=10000),
+        worker_count)
 
-    countries = {
-        "iso": {},
-        "iso3": {},
-        "fips": {}
-    }
 
-    for row in csv.reader(
-            [line for line in r.text.splitlines() if line[0] != '#'],
-            delimiter='\t'):
-        countries["iso"][row[0]] = row[4]
-        countries["iso3"][row[1]] = row[4]
-        countries["fips"][row[3]] = row[4]
+def entry_name(object_type, value):
+    """ Name of entry or alias value, as written by mitre-attack.py """
+    value = ATTACK_ID.sub("", value)
 
-    return countries
+    if object_type in LOWER_CASE:
+        return value.lower()
 
+    return value
 
-def add_to_act(client, ta_list):
-    countries = countrylist()
 
-    for ta in ta_list["values"]:
-        name = ta["value"]
+def add_entry(submitter, alias_graph, countries, typed_entry):
+    """ Add facts for the meta fields of a galaxy cluster entry, as given by MAPPINGS """
+    (object_type, entry) = typed_entry
+    name = entry_name(object_type, entry["value"])
 
-        if "meta" not in ta:
-            warning("Missing meta information in MISP on Threat Actor {}".format(name))
-            continue
+    metrics.inc("entries_total", source="misp", object_type=object_type)
 
-        aliases = ta["meta"].get("synonyms", [])
-        country = ta["meta"].get("country", None)
+    if "meta" not in entry:
+        warning("Missing meta information in MISP on {} {}".format(object_type, name))
+        return
 
-        location = None
+    for (field, fact_type, kind) in MAPPINGS[object_type]:
+        values = entry["meta"].get(field) or []
 
-        if country and country in countries["iso"]:
-            location = countries["iso"][country]
-        elif country and country in countries["iso3"]:
-            location = countries["iso3"][country]
-            error(
-                "country code is not valid ISO code, but found match in iso3: %s\n" %
-                country)
-        elif country and country in countries["fips"]:
-            location = countries["fips"][country]
-            error(
-                "country code is not valid ISO code, but found match in fips3: %s\n" %
-                country)
-        else:
-            location = None
+        if not isinstance(values, list):
+            values = [values]
 
-        if location:
-            client.fact("sourceGeography")\
-                .destination("location", location)\
-                .source("threatActor", name)\
-                .add()
+        for value in values:
+            if kind == "alias":
+                alias_graph.add(fact_type, object_type, name, entry_name(object_type, value))
+            elif kind == "location":
+                add_location(submitter, countries, fact_type, object_type, name, value)
 
-        elif country:
-            warning(
-                "country code not found in ISO, ISO3 or FIPS: %s\n" %
-                country)
 
-        # Loop over all items under indicators in report
-        for alias in aliases:
-            if alias == name:
-                continue  # Do not alias to ourself
-            client.fact("threatActorAlias")\
-                .bidirectional("threatActor", alias, "threatActor", name)\
-                .add()
+def add_location(submitter, countries, fact_type, object_type, name, country):
+    (location, source) = countries.lookup(country)
+
+    if source in ("iso3", "fips"):
+        error(
+            "country code is not valid ISO code, but found match in %s: %s\n" %
+            (source, country))
+
+    if location:
+        submitter.submit(submitter.client.fact(fact_type)
+                         .destination("location", location)
+                         .source(object_type, name))
+
+    else:
+        warning(
+            "country code not found in ISO, ISO3 or FIPS: %s\n" %
+            country)
 
 
 if __name__ == '__main__':
@@ -125,8 +206,31 @@ if __name__ == '__main__':
         args.log_file,
         "misp-threat-actors")
 
-    # Get all reports from SCIO
-    ta = get_misp_threat_actors()
+    httpcache.configure(args)
+    metrics.configure(args)
+
+    submitter = FactSubmitter(
+        client,
+        session=workers.session_from_args(args),
+        store=factstore.from_args(args, client),
+        fact_check=catalogue.from_args(args))
+
+    alias_graph = aliases.AliasGraph()
+
+    # Add facts from all galaxy clusters to the ACT platform. Clusters are
+    # fetched while they are parsed and inserted, so this includes the fetch
+    with metrics.phase("misp_insert"):
+        add_clusters(submitter, alias_graph, args.clusters, args.workers)
+
+    # Each alias pair is only added once, after all clusters are read
+    with metrics.phase("aliases_submit"):
+        alias_graph.submit(submitter)
+
+    if args.alias_clusters:
+        alias_graph.write_clusters(args.alias_clusters)
+
+    # Send remaining facts
+    with metrics.phase("submit_flush"):
+        submitter.close()
 
-    # Add IOCs from reports to the ACT platform
-    add_to_act(client, ta)
+    metrics.finish(args)
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 
+import functools
 import json
 import os
 import sys
 import argparse
 from logging import error
 import urllib3
-import requests
 import act
+import aliases
+import catalogue
+import checkpoint
+import factstore
+import httpcache
+import jsonstream
+import metrics
+import workers
+from submit import FactSubmitter
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 MITRE_ATTACK_URL = "https://attack.mitre.org/api.php"
@@ -20,17 +29,28 @@ MITRE_MOBILE_URL = "https://attack.mitre.org/mobile/api.php"
 MITRE_ALL_PROPERTIES = "Alias instance", "Allows value", "Bypasses defense", "Citation key", "Citation reference", "Citation resource", "Citation text", "Corresponds to", "Creation date", "Display precision of", "Display title of", "Display units", "Equivalent URI", "Has CAPEC ID", "Has ID", "Has URL", "Has alias", "Has alias description", "Has alias object", "Has analytic details", "Has analytic idea", "Has authors", "Has citation", "Has contributor", "Has data source", "Has day", "Has default form", "Has description", "Has detective capability", "Has display name", "Has effective permissions", "Has examples", "Has fields", "Has groups/malware", "Has improper value for", "Has link text", "Has mitigation", "Has month", "Has name", "Has network requirements", "Has platform", "Has preferred property label", "Has processing error", "Has processing error text", "Has property description", "Has query", "Has reference type", "Has remote support", "Has software", "Has software description", "Has software object", "Has software page", "Has software type", "Has subobject", "Has tactic", "Has technical description", "Has technique", "Has technique description", "Has technique name", "Has technique object", "Has title", "Has type", "Has year", "Imported from", "Is a new page", "Language code", "Modification date", "Number of page views", "Page author", "Page creator", "Provides service", "Query depth", "Query format", "Query parameters", "Query size", "Query source", "Query string", "Requires permissions", "Requires system", "Retrieved on", "Software instance", "Subcategory of", "Subproperty of", "Technique instance", "Text", "Uses software"
 
 
-def parseargs():
+def parseargs(argv=None):
     """ Parse arguments """
     parser = argparse.ArgumentParser(description='Insert (mitre) att&ck data into ACT')
     parser.add_argument('--userid', dest='user_id', help="User ID")
     parser.add_argument('--act-baseurl', dest='act_baseurl', help='API URI')
     parser.add_argument('--models', dest='models', default="all", help='Models (all, attack or pre-attack). Default = all"')
     parser.add_argument('--dump', dest='dump', help='Dump JSON-output to directory')
+    parser.add_argument('--from-dump', dest='from_dump', help='Read JSON-output from a --dump directory, instead of querying att&ck')
     parser.add_argument("--logfile", dest="log_file", help="Log to file (default = stdout)")
     parser.add_argument("--loglevel", dest="log_level", default="info", help="Loglevel (default = info)")
-
-    args = parser.parse_args()
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=500, help='Number of facts to send per batch (default = 500)')
+    parser.add_argument('--max-in-flight', dest='max_in_flight', type=int, default=10, help='Maximum number of concurrent requests to the ACT API (default = 10)')
+    parser.add_argument('--prefetch', dest='prefetch', type=int, default=10000, help='Maximum number of results to buffer per query while queries run concurrently, 0 = unlimited (default = 10000)')
+    workers.add_arguments(parser)
+    factstore.add_arguments(parser)
+    httpcache.add_arguments(parser)
+    aliases.add_arguments(parser)
+    checkpoint.add_arguments(parser)
+    catalogue.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args(argv)
 
     if not (args.dump or (args.user_id and args.act_baseurl)):
         sys.stderr.write("Must specify either --dump or --userid and --act-baseurl")
@@ -39,10 +59,10 @@ def parseargs():
     return args
 
 def extract_groups_from_attack(response):
-    groups = {}
-    for _id, data in response.items():
+    """ Yield (id, group) for each (id, data) entry in response """
+    for _id, data in response:
         printouts = data.get("printouts", {})
-        groups[_id] = {
+        entry = {
             "title": printouts.get("Has display name")[0],
             "threatActorAlias": printouts.get("Has alias", []),
             "hasDescription": printouts.get("Has description", [])[0],
@@ -52,13 +72,13 @@ def extract_groups_from_attack(response):
             "creattion_date": int(printouts.get("Creation date")[0]["timestamp"]),
         }
 
-    return groups
+        yield (_id, entry)
 
 def extract_techniques_from_attack(response):
-    techniques = {}
-    for _id, data in response.items():
+    """ Yield (id, technique) for each (id, data) entry in response """
+    for _id, data in response:
         printouts = data.get("printouts", {})
-        techniques[_id] = {
+        entry = {
             "title": printouts.get("Has display name")[0],
             "hasDataSource": printouts.get("Has data source", []),
             "usesPlatform": printouts.get("Has platform", []),
@@ -68,33 +88,33 @@ def extract_techniques_from_attack(response):
         }
 
         if printouts.get("Has technical description", []):
-            techniques[_id]["hasDescription"] = printouts["Has technical description"][0]
+            entry["hasDescription"] = printouts["Has technical description"][0]
 
         if printouts.get("Has mitigation", []):
-            techniques[_id]["mitigation"] = printouts["Has mitigation"][0]
+            entry["mitigation"] = printouts["Has mitigation"][0]
 
         if printouts.get("Has analytic details", []):
-            techniques[_id]["analytics"] = printouts["Has analytic details"][0]
+            entry["analytics"] = printouts["Has analytic details"][0]
 
-    return techniques
+        yield (_id, entry)
 
 def extract_tactics_from_attack(response):
-    tactics = {}
-    for _id, data in response.items():
+    """ Yield (id, tactic) for each (id, data) entry in response """
+    for _id, data in response:
         printouts = data.get("printouts", {})
-        tactics[_id] = {
+        entry = {
             "title": _id,
             "hasDescription": printouts.get("Has description", ["N/A"])[0],
             "creattion_date": int(printouts.get("Creation date")[0]["timestamp"]),
         }
 
-    return tactics
+        yield (_id, entry)
 
 def extract_software_from_attack(response):
-    software = {}
-    for _id, data in response.items():
+    """ Yield (id, software) for each (id, data) entry in response """
+    for _id, data in response:
         printouts = data.get("printouts", {})
-        software[_id] = {
+        entry = {
             "title": printouts.get("Has display name")[0],
             "toolAlias": printouts.get("Has alias", []),
             "hasDescription": printouts.get("Has description", [])[0],
@@ -103,9 +123,9 @@ def extract_software_from_attack(response):
             "creattion_date": int(printouts.get("Creation date")[0]["timestamp"]),
         }
 
-    return software
+        yield (_id, entry)
 
-def attack_fact(client, source_type, source_values, fact_type, destination_type, destination_values, link_type="linked"):
+def attack_fact(submitter, source_type, source_values, fact_type, destination_type, destination_values, link_type="linked"):
     if isinstance(destination_values, str):
         destination_values = [destination_values]
 
@@ -113,58 +133,80 @@ def attack_fact(client, source_type, source_values, fact_type, destination_type,
         source_values = [source_values]
 
     for source_value in source_values:
-        try:
-            for destination_value in destination_values:
-                if source_type == destination_type and source_value == destination_value:
-                    continue # Do not link to itself
-
-                if link_type == "linked":
-                    client.fact(fact_type)\
-                        .source(source_type, source_value)\
-                        .destination(destination_type, destination_value)\
-                        .add()
-                elif link_type == "bidirectional":
-                    client.fact(fact_type)\
-                        .bidirectional(source_type, source_value)\
-                        .bidirectional(destination_type, destination_value)\
-                        .add()
-                else:
-                    error("Illegal link_type: %s" % link_type)
-        except act.base.ResponseError as e:
-            error(e)
-            continue
-
-def insert_techniques(client, technique):
-    for (_, data) in technique.items():
-        title = data["title"]
-        # description = data["hasDescription"]
-        attack_fact(client, "tactic", data["hasTactic"], "usesTechnique", "technique", title)
-
-def insert_groups(client, groups, software):
-    for (_, data) in groups.items():
-        title = data["title"]
-        # description = data["hasDescription"]
-        attack_fact(client, "threatActor", title, "threatActorAlias", "threatActor", data["threatActorAlias"], link_type="bidirectional")
-        attack_fact(client, "threatActor", title, "usesTechnique", "technique", data["usesTechnique"])
-
-        # Lookup software title from id
-        tools = [software[software_id]["title"] for software_id in data["usesTool"]]
-
-        # To lower case
-        tools = [tool.lower() for tool in tools]
-        attack_fact(client, "threatActor", title, "usesTool", "tool", tools)
-
-def insert_software(client, software):
-    for (_, data) in software.items():
-        title = data["title"].lower()
-        # description = data["hasDescription"]
-        tool_alias = [alias.lower() for alias in data["toolAlias"]]
-        attack_fact(client, "tool", title, "toolAlias", "tool", tool_alias, link_type="bidirectional")
-
-
-def mediawiki_ask(url, q, properties = None, limit = 99999):
-    filtered_result = {}
+        for destination_value in destination_values:
+            if source_type == destination_type and source_value == destination_value:
+                continue # Do not link to itself
+
+            if link_type == "linked":
+                submitter.submit(submitter.client.fact(fact_type)
+                                 .source(source_type, source_value)
+                                 .destination(destination_type, destination_value))
+            elif link_type == "bidirectional":
+                submitter.submit(submitter.client.fact(fact_type)
+                                 .bidirectional(source_type, source_value, destination_type, destination_value))
+            else:
+                error("Illegal link_type: %s" % link_type)
+
+def checkpoint_keys(name, entries):
+    """ (checkpoint key, data) for (id, data) in entries of category name """
+    return (("%s/%s" % (name, _id), data) for (_id, data) in entries)
+
+def insert_techniques(submitter, technique, worker_count=1, progress=None, name="attack_technique"):
+    workers.run(functools.partial(insert_technique, submitter, progress), checkpoint_keys(name, technique), worker_count)
+
+def insert_technique(submitter, progress, entry):
+    (key, data) = entry
+    if progress and progress.done(key):
+        return
+
+    title = data["title"]
+    # description = data["hasDescription"]
+    attack_fact(submitter, "tactic", data["hasTactic"], "usesTechnique", "technique", title)
+
+    if progress:
+        progress.mark(key)
+
+def insert_groups(submitter, alias_graph, groups, software, worker_count=1, progress=None, name="attack_group"):
+    workers.run(functools.partial(insert_group, submitter, alias_graph, software, progress), checkpoint_keys(name, groups), worker_count)
+
+def insert_group(submitter, alias_graph, software, progress, entry):
+    (key, data) = entry
+    title = data["title"]
+    # description = data["hasDescription"]
+
+    # Aliases are submitted from the alias graph at the end, so they are added even if the group is committed
+    alias_graph.add("threatActorAlias", "threatActor", title, data["threatActorAlias"])
+
+    if progress and progress.done(key):
+        return
+
+    attack_fact(submitter, "threatActor", title, "usesTechnique", "technique", data["usesTechnique"])
+
+    # Lookup software title from id
+    tools = [software[software_id]["title"] for software_id in data["usesTool"]]
+
+    # To lower case
+    tools = [tool.lower() for tool in tools]
+    attack_fact(submitter, "threatActor", title, "usesTool", "tool", tools)
 
+    if progress:
+        progress.mark(key)
+
+def insert_software(alias_graph, software, worker_count=1):
+    workers.run(functools.partial(insert_tool, alias_graph), (data for (_, data) in software), worker_count)
+
+def insert_tool(alias_graph, data):
+    title = data["title"].lower()
+    # description = data["hasDescription"]
+    tool_alias = [alias.lower() for alias in data["toolAlias"]]
+    alias_graph.add("toolAlias", "tool", title, tool_alias)
+
+
+def mediawiki_ask(url, q, properties = None, limit = 500):
+    """
+    Yield (key, value) for each result of the query, with empty printouts
+    filtered out. Results are fetched in pages of limit entries.
+    """
     if not properties:
         properties = []
 
@@ -173,33 +215,124 @@ def mediawiki_ask(url, q, properties = None, limit = 99999):
     if properties_query:
         properties_query = "|" + properties_query
 
-    payload = {
-        "action": "ask",
-        "format": "json",
-        "query": "%s%s|limit=%s" % (q, properties_query, limit)
-    }
+    offset = 0
+
+    while offset is not None:
+        payload = {
+            "action": "ask",
+            "format": "json",
+            "query": "%s%s|limit=%s|offset=%s" % (q, properties_query, limit, offset)
+        }
+
+        r = httpcache.get(url, params = payload, verify = False).json()
 
-    r = requests.get(url, params = payload, verify = False).json()
+        if "error" in r:
+            error("url:%s, payload: %s, error: %s" % (url, payload, r["error"]))
+            return
 
-    if "error" in r:
-        error("url:%s, payload: %s, error: %s" % (url, payload, r["error"]))
+        # Results is an empty list (not dict) if there are no results
+        for (key, value) in (r.get("query", {}).get("results") or {}).items():
+            # Filter out empty values
+            value["printouts"] = {p_key: p_val for (p_key, p_val) in value["printouts"].items() if p_val}
+            yield (key, value)
 
-    if "query" in r:
-        # Filter out empty values
-        for (key, value) in r["query"]["results"].items():
-            f_val = value
-            f_val["printouts"] = {p_key: p_val for (p_key, p_val) in value["printouts"].items() if p_val}
-            filtered_result[key] = f_val
+        # Offset of next page, both for old (query-continue-offset) and new (continue) style
+        offset = r.get("query-continue-offset", r.get("continue", {}).get("offset"))
 
-    return filtered_result
+def prefetch_ask(url, q, maxsize=0):
+    """ Run mediawiki_ask() with all properties in the background, see workers.prefetch() """
+    return workers.prefetch(mediawiki_ask(url, q, MITRE_ALL_PROPERTIES), maxsize)
+
+def load_dump(filename):
+    """ Yield (key, value) for each entry in a file written by out_result() """
+    with open(filename, "rb") as f:
+        yield from jsonstream.iter_items(f)
+
+def category(args, name, url, q):
+    """ Results of query q, named name in dumps. Read from --from-dump if specified, otherwise queried in the background """
+    if args.from_dump:
+        return load_dump(os.path.join(args.from_dump, "%s.json" % name))
+
+    return prefetch_ask(url, q, args.prefetch)
 
 def out_result(filename, entries):
+    """ Write (key, value) entries to filename as a JSON object, one entry per line """
     with open(filename, "w") as f:
-        f.write(json.dumps(
-            entries,
-            sort_keys=True,
-            indent=4,
-            separators=(',', ': ')))
+        f.write("{")
+        for (i, (key, value)) in enumerate(entries):
+            f.write("%s\n%s: %s" % ("," if i else "", json.dumps(key), json.dumps(value, sort_keys=True)))
+        f.write("\n}\n")
+
+
+def fetch_categories(args):
+    """
+    Start the queries for the models in args.models, and return dict of
+    name -> results. All queries run concurrently, and results are consumed
+    as they arrive. Names are the same as the files written with --dump.
+    """
+    raw = {}
+
+    if args.models in ("all", "attack", "pre-attack"):
+        # Attack software is referenced both from attack and pre-attack
+        raw["attack_software"] = category(args, "attack_software", MITRE_ATTACK_URL, "[[Category:Software]]")
+
+    if args.models == "all" or args.models == "attack":
+        raw["attack_group"] = category(args, "attack_group", MITRE_ATTACK_URL, "[[Category:Group]]")
+        raw["attack_technique"] = category(args, "attack_technique", MITRE_ATTACK_URL, "[[Category:Technique]]")
+
+        # Tactics and citations are only dumped, not inserted
+        if args.dump:
+            raw["attack_tactic"] = category(args, "attack_tactic", MITRE_ATTACK_URL, "[[Category:Tactic]]")
+            raw["attack_citation"] = category(args, "attack_citation", MITRE_ATTACK_URL, "[[Citation text::+]]")
+
+    if args.models == "all" or args.models == "pre-attack":
+        raw["pre-attack_group"] = category(args, "pre-attack_group", MITRE_PRE_ATTACK_URL, "[[Category:Group]]")
+        # Seems like pre-attack software (tools) does not exist
+        # raw["pre-attack_software"] = category(args, "pre-attack_software", MITRE_PRE_ATTACK_URL, "[[Category:Software]]")
+        raw["pre-attack_technique"] = category(args, "pre-attack_technique", MITRE_PRE_ATTACK_URL, "[[Category:Technique]]")
+
+        if args.dump:
+            raw["pre-attack_tactic"] = category(args, "pre-attack_tactic", MITRE_PRE_ATTACK_URL, "[[Category:Tactic]]")
+            raw["pre-attack_citation"] = category(args, "pre-attack_citation", MITRE_PRE_ATTACK_URL, "[[Citation text::+]]")
+
+    return raw
+
+
+def dump_categories(directory, raw):
+    """ Write results from fetch_categories() to directory """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for (name, entries) in raw.items():
+        out_result("%s/%s.json" % (directory, name), entries)
+
+
+def insert_attack(submitter, alias_graph, raw, models="all", worker_count=1, progress=None):
+    """
+    Insert facts from results of fetch_categories(). Aliases are added
+    to alias_graph, and must be submitted from there. Techniques and groups
+    committed before the previous run failed are skipped with progress
+    (a checkpoint.Checkpoint).
+    """
+    if models in ("all", "attack", "pre-attack"):
+        attack_software = dict(extract_software_from_attack(raw["attack_software"]))
+
+    if models in ("all", "attack"):
+        attack_technique = extract_techniques_from_attack(raw["attack_technique"])
+        attack_group = extract_groups_from_attack(raw["attack_group"])
+
+        insert_techniques(submitter, attack_technique, worker_count, progress, "attack_technique")
+        insert_software(alias_graph, attack_software.items(), worker_count)
+        insert_groups(submitter, alias_graph, attack_group, attack_software, worker_count, progress, "attack_group")
+
+    if models in ("all", "pre-attack"):
+        pre_attack_technique = extract_techniques_from_attack(raw["pre-attack_technique"])
+        pre_attack_group = extract_groups_from_attack(raw["pre-attack_group"])
+
+        insert_techniques(submitter, pre_attack_technique, worker_count, progress, "pre-attack_technique")
+
+        # Note: Links to attack_software (not preattack)
+        insert_groups(submitter, alias_graph, pre_attack_group, attack_software, worker_count, progress, "pre-attack_group")
 
 
 if __name__ == '__main__':
@@ -212,68 +345,39 @@ if __name__ == '__main__':
         args.log_file,
         "mitre-attack")
 
-    if args.models in ("all", "attack", "pre-attack"):
-        attack_software_raw = mediawiki_ask(MITRE_ATTACK_URL, "[[Category:Software]]", MITRE_ALL_PROPERTIES)
-
-    if args.models == "all" or args.models == "attack":
-        attack_group_raw = mediawiki_ask(MITRE_ATTACK_URL, "[[Category:Group]]", MITRE_ALL_PROPERTIES)
-        attack_technique_raw = mediawiki_ask(MITRE_ATTACK_URL, "[[Category:Technique]]", MITRE_ALL_PROPERTIES)
-        attack_tactic_raw = mediawiki_ask(MITRE_ATTACK_URL, "[[Category:Tactic]]", MITRE_ALL_PROPERTIES)
-        attack_citation_raw = mediawiki_ask(MITRE_ATTACK_URL, "[[Citation text::+]]", MITRE_ALL_PROPERTIES)
+    httpcache.configure(args)
+    metrics.configure(args)
 
-    if args.models == "all" or args.models == "pre-attack":
-        pre_attack_group_raw = mediawiki_ask(MITRE_PRE_ATTACK_URL, "[[Category:Group]]", MITRE_ALL_PROPERTIES)
-        # Seems like pre-attack software (tools) does not exist
-        # pre_attack_software_raw = mediawiki_ask(MITRE_PRE_ATTACK_URL, "[[Category:Software]]", MITRE_ALL_PROPERTIES)
-        pre_attack_technique_raw = mediawiki_ask(MITRE_PRE_ATTACK_URL, "[[Category:Technique]]", MITRE_ALL_PROPERTIES)
-        pre_attack_tactic_raw = mediawiki_ask(MITRE_PRE_ATTACK_URL, "[[Category:Tactic]]", MITRE_ALL_PROPERTIES)
-        pre_attack_citation_raw = mediawiki_ask(MITRE_PRE_ATTACK_URL, "[[Citation text::+]]", MITRE_ALL_PROPERTIES)
+    raw = fetch_categories(args)
 
     if args.dump:
-        if not os.path.isdir(args.dump):
-            os.makedirs(args.dump)
-
-        if args.models in ("all", "attack", "pre-attack"):
-            # Attack software is referenced both from attack and pre-attack
-            out_result("%s/attack_software.json" % args.dump, attack_software_raw)
-
-        if args.models in ("all", "attack"):
-            out_result("%s/attack_group.json" % args.dump, attack_group_raw)
-            out_result("%s/attack_technique.json" % args.dump, attack_technique_raw)
-            out_result("%s/attack_tactic.json" % args.dump, attack_tactic_raw)
-            out_result("%s/attack_citation.json" % args.dump, attack_citation_raw)
-
-        if args.models in ("all", "pre-attack"):
-            out_result("%s/pre-attack_group.json" % args.dump, pre_attack_group_raw)
-
-            # Semms like pre-attack software (tools) does not exist
-            # out_result("%s/pre-attack_software.json" % args.dump, pre_attack_software_raw)
-            out_result("%s/pre-attack_technique.json" % args.dump, pre_attack_technique_raw)
-            out_result("%s/pre-attack_tactic.json" % args.dump, pre_attack_tactic_raw)
-            out_result("%s/pre-attack_citation.json" % args.dump, pre_attack_citation_raw)
+        with metrics.phase("mitre_dump"):
+            dump_categories(args.dump, raw)
 
     else:
+        session = workers.session_from_args(args, pool_size=args.max_in_flight)
+        submitter = FactSubmitter(client, args.batch_size, args.max_in_flight, session,
+                                  factstore.from_args(args, client), catalogue.from_args(args))
+        alias_graph = aliases.AliasGraph()
+        progress = checkpoint.from_args(args, "mitre-attack", client)
+        submitter.add_checkpoint(progress)
 
-        if args.models in ("all", "attack", "pre-attack"):
-            attack_software = extract_software_from_attack(attack_software_raw)
-
-        if args.models in ("all", "attack"):
-            attack_tactic = extract_tactics_from_attack(attack_tactic_raw)
-            attack_technique = extract_techniques_from_attack(attack_technique_raw)
-            attack_group = extract_groups_from_attack(attack_group_raw)
+        # Results are fetched while they are inserted, so this includes the fetch
+        with metrics.phase("mitre_insert"):
+            insert_attack(submitter, alias_graph, raw, args.models, args.workers, progress)
 
-            insert_techniques(client, attack_technique)
-            insert_software(client, attack_software)
-            insert_groups(client, attack_group, attack_software)
+        # Each alias pair is only added once, after all groups and software are read
+        with metrics.phase("aliases_submit"):
+            alias_graph.submit(submitter)
 
-        if args.models in ("all", "pre-attack"):
-            pre_attack_tactic = extract_tactics_from_attack(pre_attack_tactic_raw)
-            pre_attack_technique = extract_techniques_from_attack(pre_attack_technique_raw)
-            pre_attack_group = extract_groups_from_attack(pre_attack_group_raw)
+        if args.alias_clusters:
+            alias_graph.write_clusters(args.alias_clusters)
 
-            insert_techniques(client, pre_attack_technique)
+        # Send remaining facts
+        with metrics.phase("submit_flush"):
+            submitter.close()
+        progress.finish()
 
-            # Note: Links to attack_software (not preattack)
-            insert_groups(client, pre_attack_group, attack_software)
+    metrics.finish(args)
 
-        # https://attack.mitre.org/wiki/Using_the_API
+# https://attack.mitre.org/wiki/Using_the_API
@@ -0,0 +1,313 @@
+""" Batched fact submission """
+
+import collections
+import concurrent.futures
+import re
+import threading
+import time
+import urllib.parse
+from logging import error
+
+import requests
+from urllib3.util.retry import Retry
+
+import act
+import metrics
+from factstore import fact_key
+
+# Responses that are worth retrying, since the platform may recover
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Endpoints that add facts and meta facts. Adding a fact that exists returns
+# the existing fact, so these POST requests are retried like idempotent ones.
+FACT_ENDPOINTS = ("/v1/fact", "/v1/fact/uuid/{id}/meta")
+
+# Number of recently submitted facts to skip duplicates of (same size as
+# the cache used by act.helpers.handle_fact)
+RECENT_FACTS = 4096
+
+UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+# Default number of concurrent requests to the ACT API
+MAX_IN_FLIGHT = 10
+
+
+class RateLimiter(object):
+    """ Allow at most rate calls per second, shared by all threads """
+
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """ Block until the next call is allowed """
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ActSession(requests.Session):
+    """
+    Session that applies a shared rate limit to all requests, and records
+    their latency. Requests that add facts are sent through fact_session,
+    which also retries POST requests.
+    """
+
+    def __init__(self, rate_limiter, fact_session=None):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+        self.fact_session = fact_session
+
+    def request(self, method, url, *args, **kwargs):
+        self.rate_limiter.wait()
+
+        endpoint = endpoint_of(url)
+        start = time.monotonic()
+
+        if self.fact_session and method.upper() == "POST" and endpoint.endswith(FACT_ENDPOINTS):
+            send = self.fact_session.request
+        else:
+            send = super().request
+
+        try:
+            response = send(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.inc("act_api_requests_total", method=method, endpoint=endpoint, status="error")
+            raise
+
+        metrics.observe("act_api_request_seconds", time.monotonic() - start, method=method, endpoint=endpoint)
+        metrics.inc("act_api_requests_total", method=method, endpoint=endpoint, status=response.status_code)
+
+        return response
+
+    def close(self):
+        super().close()
+        if self.fact_session:
+            self.fact_session.close()
+
+
+def endpoint_of(url):
+    """ Path of url, with ids replaced by {id}, e.g. /v1/factType/{id} """
+    return UUID.sub("{id}", urllib.parse.urlparse(url).path)
+
+
+def mount(session, pool_size, retry):
+    """ Mount a keep-alive adapter with room for pool_size connections on session """
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def pooled_session(pool_size=MAX_IN_FLIGHT, rate_limit=0, retries=0):
+    """
+    Create a keep-alive session with room for pool_size concurrent
+    connections, for the clients given to use_session().
+
+    Requests are limited to rate_limit per second (0 = unlimited).
+    Connection errors and RETRY_STATUS responses are retried up to retries
+    times with exponential backoff, for idempotent requests and for requests
+    that add facts (FACT_ENDPOINTS). Other POST requests, like those that
+    create types, are only retried if the connection could not be made.
+    """
+    def retry(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS):
+        return Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUS,
+            allowed_methods=allowed_methods,
+            raise_on_status=False)
+
+    fact_session = requests.Session()
+    mount(fact_session, pool_size, retry(Retry.DEFAULT_ALLOWED_METHODS | {"POST"}))
+
+    session = ActSession(RateLimiter(rate_limit), fact_session)
+    mount(session, pool_size, retry())
+
+    return session
+
+
+class ClientRequests(object):
+    """
+    Stand-in for the requests module in act.base, which sends every API
+    request through requests.request(). The session given to a client with
+    use_session() comes as the session keyword argument, and requests
+    without one are sent with requests.request(), as before.
+    """
+
+    def request(self, method, url, session=None, **kwargs):
+        return (session or requests).request(method, url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def use_session(client, session):
+    """
+    Send the ACT API requests of client (an act.Act), and of the types,
+    objects and facts it creates, through session. Other clients in the
+    process are not affected.
+
+    The session is added to the requests_common_kwargs of the client config,
+    which act.base.request() passes on to requests.request().
+    """
+    if not isinstance(act.base.requests, ClientRequests):
+        act.base.requests = ClientRequests()
+
+    client.config.requests_common_kwargs = dict(client.config.requests_common_kwargs or {}, session=session)
+
+
+def add_fact(fact):
+    """
+    Add fact to the platform, log (but do not raise) response errors.
+
+    Returns True if the fact was added.
+    """
+    try:
+        fact.add()
+    except act.base.ResponseError as e:
+        error(e)
+        metrics.inc("facts_total", result="failed")
+        return False
+
+    metrics.inc("facts_total", result="added")
+    return True
+
+
+class FactSubmitter(object):
+    """
+    Collect facts and add them to the platform in batches of batch_size,
+    with at most max_in_flight requests running at the same time.
+
+    The ACT API does not have a bulk endpoint for facts, so each batch is
+    sent as concurrent requests over a pooled keep-alive session.
+
+    Facts found in store (a factstore.FactStore) or among the RECENT_FACTS
+    last submitted facts are skipped. If act_baseurl is not configured,
+    facts are printed instead of added.
+
+    Checkpoints (checkpoint.Checkpoint) added with add_checkpoint() are
+    committed each time a batch has been sent. Batches are sent
+    concurrently when several threads submit facts, so checkpoints are
+    committed in batch order, once all earlier batches are sent too.
+
+    Facts are checked against the type catalogue with fact_check (a
+    catalogue.FactCheck), and skipped if it does not accept them.
+    """
+
+    def __init__(self, client, batch_size=500, max_in_flight=MAX_IN_FLIGHT, session=None, store=None,
+                 fact_check=None):
+        self.client = client
+        self.batch_size = batch_size
+        self.store = store
+        self.fact_check = fact_check
+        self.pending = []
+        self.recent = collections.OrderedDict()
+        self.checkpoints = []
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        self.batches = 0        # Sequence number of the next batch
+        self.committed = 0      # Sequence number of the next batch to commit checkpoints for
+        self.sent = {}          # Sequence number -> marked entities, of sent batches not committed yet
+        self.failed = set()     # Keys of facts that failed
+        self.session = session or pooled_session(max_in_flight)
+        use_session(client, self.session)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_in_flight)
+
+    def submit(self, fact):
+        """ Queue fact for submission, and send the batch if it is full """
+        if self.fact_check and not self.fact_check.accept(fact):
+            metrics.inc("facts_total", result="invalid")
+            return
+
+        key = fact_key(fact)
+
+        for checkpoint in self.checkpoints:
+            checkpoint.record(key)
+
+        if self.store and self.store.seen(key):
+            metrics.inc("facts_total", result="skipped_existing")
+            return
+
+        with self.lock:
+            if key in self.recent:
+                self.recent.move_to_end(key)
+                metrics.inc("facts_total", result="skipped_duplicate")
+                return
+
+            self.recent[key] = True
+
+            if len(self.recent) > RECENT_FACTS:
+                self.recent.popitem(last=False)
+
+            if not self.client.config.act_baseurl:
+                metrics.inc("facts_total", result="printed")
+                print(fact)
+                return
+
+            self.pending.append((fact, key))
+            full = len(self.pending) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def add_checkpoint(self, checkpoint):
+        """ Commit checkpoint when facts submitted so far are sent """
+        self.checkpoints.append(checkpoint)
+
+    def flush(self):
+        """ Send all queued facts and wait for the requests to complete """
+        with self.lock:
+            batch, self.pending = self.pending, []
+            sequence = self.batches
+            self.batches += 1
+
+            # Entities marked by now have all their facts in this or earlier batches
+            marked = [(checkpoint, checkpoint.prepare()) for checkpoint in self.checkpoints]
+
+        # add_fact() handles response errors, so one failing fact does not
+        # abort the rest of the batch
+        added = list(self.executor.map(add_fact, [fact for (fact, _) in batch]))
+
+        if self.store:
+            for ((_, key), ok) in zip(batch, added):
+                if ok:
+                    self.store.add(key)
+
+            self.store.commit()
+
+        # A batch that raised is never committed, and neither are the batches after it
+        with self.commit_lock:
+            self.failed.update(key for ((_, key), ok) in zip(batch, added) if not ok)
+            self.sent[sequence] = marked
+
+            while self.committed in self.sent:
+                for (checkpoint, entities) in self.sent.pop(self.committed):
+                    checkpoint.commit(entities, self.failed)
+                self.committed += 1
+
+    def close(self):
+        """ Send remaining facts and release the worker threads """
+        self.flush()
+        self.executor.shutdown()
+        self.session.close()
+
+        if self.store:
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
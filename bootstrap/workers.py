@@ -0,0 +1,116 @@
+""" Worker pool shared by the importers """
+
+import concurrent.futures
+import queue
+import threading
+
+from submit import MAX_IN_FLIGHT, pooled_session
+
+
+def add_arguments(parser):
+    """ Add worker pool, rate limit and retry arguments to parser """
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of concurrent workers (default = 1)")
+    parser.add_argument(
+        "--rate-limit",
+        dest="rate_limit",
+        type=float,
+        default=0,
+        help="Maximum ACT API requests per second, 0 = unlimited (default = 0)")
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Retries, with exponential backoff, on failed ACT API requests (default = 3)")
+
+
+def session_from_args(args, pool_size=None):
+    """
+    Create the pooled session for ACT API requests, with the rate limit and
+    retries given on the command line
+    """
+    return pooled_session(
+        max(pool_size or MAX_IN_FLIGHT, args.workers),
+        rate_limit=args.rate_limit,
+        retries=args.retries)
+
+
+def run(func, items, workers=1):
+    """
+    Call func on each item, using up to workers concurrent threads. Items
+    are consumed as they are needed, so items can be a stream.
+    """
+    if workers <= 1:
+        for item in items:
+            func(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+
+        for item in items:
+            if len(pending) >= workers * 2:
+                (done, pending) = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                # Raise any exception from func
+                for future in done:
+                    future.result()
+
+            pending.add(executor.submit(func, item))
+
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+
+
+def prefetch(items, maxsize=0):
+    """
+    Consume items in a background thread, buffering up to maxsize items
+    (0 = unlimited), and return a generator over the buffered items.
+    Exceptions raised by items are raised again by the generator.
+    """
+    return merge([items], maxsize)
+
+
+def merge(streams, maxsize=0):
+    """
+    Consume each of streams in its own background thread, buffering up to
+    maxsize items (0 = unlimited), and return a generator over the items
+    of all streams in the order they arrive. Exceptions raised by any of
+    the streams are raised again by the generator.
+    """
+    streams = list(streams)
+    buffer = queue.Queue(maxsize)
+    done = object()
+
+    def produce(items):
+        try:
+            for item in items:
+                buffer.put((item, None))
+        except Exception as e:  # pylint: disable=broad-except
+            buffer.put((done, e))
+            return
+
+        buffer.put((done, None))
+
+    for items in streams:
+        threading.Thread(target=produce, args=(items,), daemon=True).start()
+
+    def consume():
+        remaining = len(streams)
+
+        while remaining:
+            (item, exception) = buffer.get()
+
+            if item is done:
+                if exception:
+                    raise exception
+                remaining -= 1
+                continue
+
+            yield item
+
+    return consume()
@@ -0,0 +1,176 @@
+""" Incremental reading of rows from large XLSX workbooks """
+
+import posixpath
+import re
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+import zipfile
+
+NS = {
+    "main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+R_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+CELL_REFERENCE = re.compile(r"^([A-Z]+)")
+COLUMN_RANGE = re.compile(r"^([A-Z]+)(:([A-Z]*))?$")
+
+
+def tag(name):
+    return "{%s}%s" % (NS["main"], name)
+
+
+def column_index(letters):
+    """ Zero based index of column letters (A = 0, Z = 25, AA = 26) """
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def sheet_path(workbook, sheet_name):
+    """ Path in workbook of worksheet with sheet_name """
+    root = ET.fromstring(workbook.read("xl/workbook.xml"))
+    rels = ET.fromstring(workbook.read("xl/_rels/workbook.xml.rels"))
+
+    targets = {rel.get("Id"): rel.get("Target") for rel in rels.findall("rel:Relationship", NS)}
+
+    for sheet in root.findall("main:sheets/main:sheet", NS):
+        if sheet.get("name") == sheet_name:
+            target = targets[sheet.get(R_ID)]
+            if target.startswith("/"):
+                return target[1:]
+            return posixpath.normpath(posixpath.join("xl", target))
+
+    raise KeyError("Sheet not found in workbook: %s" % sheet_name)
+
+
+def text(element):
+    """ Text of shared or inline string, ignoring phonetic hints """
+    return "".join(t.text or "" for t in element.findall("main:t", NS) + element.findall("main:r/main:t", NS))
+
+
+def shared_strings(workbook):
+    """ List of shared strings in workbook """
+    if "xl/sharedStrings.xml" not in workbook.namelist():
+        return []
+
+    strings = []
+
+    with workbook.open("xl/sharedStrings.xml") as f:
+        for (_, element) in ET.iterparse(f):
+            if element.tag == tag("si"):
+                strings.append(text(element))
+                element.clear()
+
+    return strings
+
+
+def cell_value(cell, strings):
+    """ Python value of cell """
+    cell_type = cell.get("t", "n")
+
+    if cell_type == "inlineStr":
+        inline = cell.find("main:is", NS)
+        return text(inline) if inline is not None else ""
+
+    value = cell.findtext("main:v", None, NS)
+
+    if value is None:
+        return ""
+    if cell_type == "s":
+        return strings[int(value)]
+    if cell_type == "b":
+        return value == "1"
+    if cell_type == "n":
+        number = float(value)
+        return int(number) if number.is_integer() else number
+
+    return value  # str, e
+
+
+def iter_rows(f, sheet_name):
+    """
+    Yield each row (list of cell values) of sheet_name in the XLSX
+    workbook f (filename or binary file object). Rows are parsed one at a
+    time, and missing cells within a row are empty strings. Streams that
+    can not seek are spooled to a temporary file first.
+    """
+    if not isinstance(f, str) and not f.seekable():
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(f, spool)
+        spool.seek(0)
+        f = spool
+
+    with zipfile.ZipFile(f) as workbook:
+        strings = shared_strings(workbook)
+
+        with workbook.open(sheet_path(workbook, sheet_name)) as sheet:
+            parent = None
+
+            for (event, element) in ET.iterparse(sheet, events=("start", "end")):
+                if event == "start":
+                    if element.tag == tag("sheetData"):
+                        parent = element
+                    continue
+
+                if element.tag != tag("row"):
+                    continue
+
+                row = []
+
+                for cell in element.findall("main:c", NS):
+                    match = CELL_REFERENCE.match(cell.get("r", ""))
+                    if match:
+                        row.extend([""] * (column_index(match.group(1)) - len(row)))
+                    row.append(cell_value(cell, strings))
+
+                # Drop parsed rows, so memory use does not grow with the sheet
+                if parent is not None:
+                    parent.clear()
+
+                yield row
+
+
+def map_row(row, columns):
+    """
+    Map row to dict, using columns, a dict of field name -> column.
+    A column is either a single column ("A"), a range ("E:G") or all
+    columns from a column to the end of the row ("E:"). Ranges are mapped
+    to a list of the non-empty values in the range.
+    """
+    mapped = {}
+
+    for (field, column) in columns.items():
+        match = COLUMN_RANGE.match(column)
+
+        if not match:
+            raise ValueError("Invalid column: %s" % column)
+
+        start = column_index(match.group(1))
+
+        if not match.group(2):
+            mapped[field] = row[start] if start < len(row) else ""
+            continue
+
+        end = column_index(match.group(3)) + 1 if match.group(3) else len(row)
+        mapped[field] = [value for value in row[start:end] if value != ""]
+
+    return mapped
+
+
+def iter_mapped_rows(f, config):
+    """
+    Yield each row of a sheet as dict, as given by config:
+
+        {
+            "sheet": "Sheet1",      # Sheet name
+            "header_rows": 1,       # Number of rows to skip (default = 0)
+            "columns": {"md5": "A", "c2": "E:"}
+        }
+    """
+    for (index, row) in enumerate(iter_rows(f, config["sheet"])):
+        if index < config.get("header_rows", 0):
+            continue
+        yield map_row(row, config["columns"])
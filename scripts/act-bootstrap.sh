@@ -44,7 +44,7 @@ export PYTHONPATH=$PYTHONPATH:${BOOTSTRAP_HOME}/bootstrap
 ARGS="--userid $USERID --act-baseurl $ACT_BASEURL --loglevel $LOGLEVEL --logfile $LOGFILE"
 
 log "Starting bootstrap process, logging to $LOGFILE"
-bootstrap/act-bootstrap.py $ARGS --object-types ${OBJECT_TYPES} --fact-types ${FACT_TYPES} --meta-fact-types ${META_FACT_TYPES}
-bootstrap/misp-threat-actors.py $ARGS
-bootstrap/fireeye-carbanak.py --md5-lookup data/carbanak_md5_sha256.txt $ARGS
+# Extra arguments are passed to the pipeline, e.g. --resume or --workers 8
+shift 2
+${BOOTSTRAP_HOME}/bootstrap/act-pipeline.py $ARGS --object-types ${OBJECT_TYPES} --fact-types ${FACT_TYPES} --meta-fact-types ${META_FACT_TYPES} --md5-lookup ${BOOTSTRAP_HOME}/data/carbanak_md5_sha256.txt "$@"
 log "Bootstraping completed"
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the bootstrap importers against a local mock of the ACT API.
+
+The mock implements the object type, fact type and fact endpoints used by
+the importers, with configurable latency and error rate. Upstream feeds
+are replaced by synthetic fixtures served from an offline HTTP cache, and
+mitre-attack.py is run with --from-dump.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+BOOTSTRAP_HOME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BOOTSTRAP_DIR = os.path.join(BOOTSTRAP_HOME, "bootstrap")
+
+sys.path.insert(0, BOOTSTRAP_DIR)
+
+
+class MockAct:
+    """State and statistics of the mock ACT API"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.object_types: Dict[str, dict] = {}
+        self.fact_types: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Reset statistics (types are kept)"""
+        with self.lock:
+            self.requests: Dict[str, int] = {}
+            self.latencies: List[float] = []
+            self.errors = 0
+            self.facts = 0
+
+    def record(self, endpoint: str, started: float) -> None:
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.latencies.append(time.perf_counter() - started)
+
+    def object_binding(self, binding: dict) -> dict:
+        return {
+            "sourceObjectType": self.object_types.get(binding.get("sourceObjectType")),
+            "destinationObjectType": self.object_types.get(binding.get("destinationObjectType")),
+            "bidirectionalBinding": binding.get("bidirectionalBinding", False),
+        }
+
+    def fact_binding(self, binding: dict) -> dict:
+        return {"id": binding["factType"], "name": self.fact_types[binding["factType"]]["name"]}
+
+
+def handler(mock: MockAct) -> type:
+    """Request handler class bound to mock"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self) -> None:
+            super().setup()
+            # Headers and body are written separately, avoid delayed ACK stalls on keep-alive connections
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def send(self, status: int, data: Any) -> None:
+            count = len(data) if isinstance(data, list) else 1
+            body = json.dumps({
+                "responseCode": status,
+                "limit": 0,
+                "count": count,
+                "size": count,
+                "data": data,
+            }).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def body(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def handle_request(self, method: str) -> None:
+            started = time.perf_counter()
+            body = self.body() if method in ("POST", "PUT") else {}
+            endpoint = "{} {}".format(method, "/".join(self.path.split("?")[0].split("/")[:3]))
+
+            time.sleep(mock.latency)
+
+            if random.random() < mock.error_rate:
+                with mock.lock:
+                    mock.errors += 1
+                self.send(503, None)
+            else:
+                (status, data) = self.dispatch(method, body)
+                self.send(status, data)
+
+            mock.record(endpoint, started)
+
+        def dispatch(self, method: str, body: dict) -> tuple:
+            path = self.path.split("?")[0]
+
+            with mock.lock:
+                if (method, path) == ("GET", "/v1/objectType"):
+                    return (200, list(mock.object_types.values()))
+
+                if (method, path) == ("GET", "/v1/factType"):
+                    return (200, list(mock.fact_types.values()))
+
+                if (method, path) == ("POST", "/v1/objectType"):
+                    object_type = {"id": str(uuid.uuid4()), "name": body["name"]}
+                    mock.object_types[object_type["id"]] = object_type
+                    return (201, object_type)
+
+                if (method, path) == ("POST", "/v1/factType"):
+                    fact_type = {
+                        "id": str(uuid.uuid4()),
+                        "name": body["name"],
+                        "relevantObjectBindings": [
+                            mock.object_binding(binding)
+                            for binding in body.get("relevantObjectBindings") or []],
+                        "relevantFactBindings": [
+                            mock.fact_binding(binding)
+                            for binding in body.get("relevantFactBindings") or []],
+                    }
+                    mock.fact_types[fact_type["id"]] = fact_type
+                    return (201, fact_type)
+
+                if method == "PUT" and path.startswith("/v1/factType/uuid/"):
+                    fact_type = mock.fact_types[path.split("/")[-1]]
+                    fact_type["relevantObjectBindings"] += [
+                        mock.object_binding(binding) for binding in body.get("addObjectBindings", [])]
+                    fact_type["relevantFactBindings"] += [
+                        mock.fact_binding(binding) for binding in body.get("addFactBindings", [])]
+                    return (200, fact_type)
+
+            if (method, path) == ("POST", "/v1/fact"):
+                with mock.lock:
+                    mock.facts += 1
+                return (201, {
+                    "id": str(uuid.uuid4()),
+                    "type": {"id": str(uuid.uuid4()), "name": body["type"]},
+                    "value": body.get("value", ""),
+                    "sourceObject": fact_object(body.get("sourceObject")),
+                    "destinationObject": fact_object(body.get("destinationObject")),
+                    "bidirectionalBinding": body.get("bidirectionalBinding", False),
+                })
+
+            return (404, None)
+
+        def do_GET(self) -> None:
+            self.handle_request("GET")
+
+        def do_POST(self) -> None:
+            self.handle_request("POST")
+
+        def do_PUT(self) -> None:
+            self.handle_request("PUT")
+
+    return Handler
+
+
+def fact_object(value: Optional[str]) -> Optional[dict]:
+    """Object in fact response, from "type/value" in the request"""
+    if not value:
+        return None
+    (object_type, object_value) = value.split("/", 1)
+    return {
+        "id": str(uuid.uuid4()),
+        "type": {"id": str(uuid.uuid4()), "name": object_type},
+        "value": object_value,
+    }
+
+
+def write_mitre_dump(directory: str, scale: int) -> None:
+    """Write synthetic --dump files for mitre-attack.py"""
+
+    def created() -> list:
+        return [{"timestamp": "1500000000"}]
+
+    software = {
+        "S{:04d}".format(i): {"printouts": {
+            "Has display name": ["Tool {}".format(i)],
+            "Has alias": ["Tool {}".format(i), "tool-alias-{}".format(i)],
+            "Has description": ["Tool"],
+            "Has software type": ["Tool"],
+            "Creation date": created()}}
+        for i in range(max(1, scale // 2))}
+
+    for model in ("attack", "pre-attack"):
+        techniques = {
+            "T{:04d}".format(i): {"printouts": {
+                "Has display name": ["{} technique {}".format(model, i)],
+                "Has tactic": [{"fulltext": "Tactic {}".format(i % 10)}],
+                "Creation date": created()}}
+            for i in range(scale * 2)}
+
+        groups = {
+            "G{:04d}".format(i): {"printouts": {
+                "Has display name": ["Group {}".format(i)],
+                "Has alias": ["Group {}".format(i), "group-alias-{}".format(i)],
+                "Has description": ["Group"],
+                "Has technique": [{"displaytitle": "{} technique {}".format(model, (i + n) % (scale * 2))}
+                                  for n in range(3)],
+                "Uses software": [{"fulltext": "S{:04d}".format(i % len(software))}],
+                "Creation date": created()}}
+            for i in range(scale)}
+
+        with open(os.path.join(directory, "{}_technique.json".format(model)), "w") as f:
+            json.dump(techniques, f)
+        with open(os.path.join(directory, "{}_group.json".format(model)), "w") as f:
+            json.dump(groups, f)
+
+    with open(os.path.join(directory, "attack_software.json"), "w") as f:
+        json.dump(software, f)
+
+
+def seed_http_cache(directory: str, scale: int) -> None:
+    """Store synthetic MISP, geonames and carbanak feeds in the HTTP cache"""
+
+    import countries as geonames
+    import httpcache
+    import pyexcel_xlsx
+
+    misp = importlib.import_module("misp-threat-actors")
+    carbanak = importlib.import_module("fireeye-carbanak")
+
+    cache = httpcache.HTTPCache(directory)
+
+    def store(url: str, body: bytes) -> None:
+        cache.store(url, {"url": url, "validated": time.time(), "headers": {}}, body)
+
+    countries = ["NO", "SE", "DK", "FI", "IS"]
+
+    store(geonames.COUNTRY_INFO_URL, "".join(
+        "{}\t{}\t0\t{}\t{}\n".format(code, code + "X", code, "Country " + code)
+        for code in countries).encode("utf8"))
+
+    store(misp.MISP_THREAT_ACTOR_URL, json.dumps({"values": [
+        {"value": "Actor {}".format(i),
+         "meta": {"country": countries[i % len(countries)],
+                  "synonyms": ["actor-alias-{}-{}".format(i, n) for n in range(3)]}}
+        for i in range(scale)]}).encode("utf8"))
+
+    with open(os.path.join(directory, "report.xlsx"), "wb") as f:
+        pyexcel_xlsx.save_data(f, {"Sheet1": [["MD5", "", "", "Campaign", "C2"]] + [
+            ["{:032x}".format(i), "", "", "Campaign {}".format(i % 10),
+             "c2-{}.example.com:443".format(i % 50), "10.0.{}.{}:80".format(i % 250, i % 7)]
+            for i in range(scale)]})
+
+    with open(os.path.join(directory, "report.xlsx"), "rb") as f:
+        store(carbanak.CARBANAK_REPORT_URL, f.read())
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def run_importer(mock: MockAct, name: str, command: List[str]) -> dict:
+    """Run importer and return statistics"""
+
+    mock.reset()
+    env = dict(os.environ, PYTHONPATH=BOOTSTRAP_DIR)
+    started = time.perf_counter()
+    result = subprocess.run(command, env=env, cwd=BOOTSTRAP_HOME,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - started
+
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr.decode("utf8", "replace"))
+
+    facts = mock.facts
+
+    return {
+        "importer": name,
+        "returncode": result.returncode,
+        "seconds": round(elapsed, 3),
+        "requests": dict(mock.requests),
+        "errors": mock.errors,
+        "facts": facts,
+        "facts_per_second": round(facts / elapsed, 1) if elapsed else 0.0,
+        "latency_p50_ms": round(percentile(mock.latencies, 0.5) * 1000, 2),
+        "latency_p99_ms": round(percentile(mock.latencies, 0.99) * 1000, 2),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    """Handle command line arguments, returning the arguments ns"""
+
+    parser = argparse.ArgumentParser(description="Benchmark the importers against a mock ACT API")
+    parser.add_argument('--latency', type=float, default=5.0, help="Latency per API request in ms (default = 5)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of API requests that fail with 503 (default = 0)")
+    parser.add_argument('--scale', type=int, default=100, help="Number of groups/actors/report rows in the fixtures (default = 100)")
+    parser.add_argument('--mitre-dump', type=str, default=None, help="Use this mitre-attack.py --dump directory instead of synthetic fixtures")
+    parser.add_argument('--json', type=str, default=None, help="Write results as JSON to this file")
+    parser.add_argument('importer_args', nargs=argparse.REMAINDER,
+                        help="Extra arguments passed to the importers (after --), e.g. -- --workers 8")
+
+    return parser.parse_args()
+
+
+def run() -> None:
+    """Main program loop"""
+
+    args = parse_args()
+    importer_args = [arg for arg in args.importer_args if arg != "--"]
+
+    mock = MockAct(args.latency / 1000, args.error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    act_baseurl = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mitre_dump = args.mitre_dump
+
+        if not mitre_dump:
+            mitre_dump = os.path.join(tmp, "mitre")
+            os.makedirs(mitre_dump)
+            write_mitre_dump(mitre_dump, args.scale)
+
+        cache_dir = os.path.join(tmp, "http")
+        seed_http_cache(cache_dir, args.scale)
+
+        common = ["--userid", "1", "--act-baseurl", act_baseurl, "--loglevel", "error"]
+        importer = common + ["--fact-store", os.path.join(tmp, "facts.db"), "--full",
+                             "--cache-dir", cache_dir, "--offline"] + importer_args
+
+        runs = [
+            ("act-bootstrap", [
+                sys.executable, "bootstrap/act-bootstrap.py"] + common + [
+                    "--object-types", "types/object-types.json",
+                    "--fact-types", "types/fact-types.json",
+                    "--meta-fact-types", "types/metafact-types.json"]),
+            ("mitre-attack", [
+                sys.executable, "bootstrap/mitre-attack.py", "--from-dump", mitre_dump] + importer),
+            ("misp-threat-actors", [
+                sys.executable, "bootstrap/misp-threat-actors.py"] + importer),
+            ("fireeye-carbanak", [
+                sys.executable, "bootstrap/fireeye-carbanak.py",
+                "--md5-lookup", "data/carbanak_md5_sha256.txt"] + importer),
+            ("act-pipeline", [
+                sys.executable, "bootstrap/act-pipeline.py", "--from-dump", mitre_dump,
+                "--stages", "types,mitre-attack,misp-threat-actors,fireeye-carbanak",
+                "--state-file", os.path.join(tmp, "pipeline.json")] + importer),
+        ]
+
+        results = [run_importer(mock, name, command) for (name, command) in runs]
+
+    server.shutdown()
+
+    print("{:<20} {:>8} {:>9} {:>7} {:>10} {:>9} {:>9} {:>7}".format(
+        "importer", "seconds", "requests", "facts", "facts/sec", "p50 ms", "p99 ms", "errors"))
+
+    for result in results:
+        print("{:<20} {:>8} {:>9} {:>7} {:>10} {:>9} {:>9} {:>7}{}".format(
+            result["importer"], result["seconds"], sum(result["requests"].values()),
+            result["facts"], result["facts_per_second"], result["latency_p50_ms"],
+            result["latency_p99_ms"], result["errors"],
+            "" if result["returncode"] == 0 else "  (exit code {})".format(result["returncode"])))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"latency_ms": args.latency, "error_rate": args.error_rate,
+                       "scale": args.scale, "importer_args": importer_args,
+                       "results": results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    run()
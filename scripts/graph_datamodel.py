@@ -1,14 +1,49 @@
 #!/usr/bin/env python3
 
 import datetime
+import hashlib
+import json
 import os
-import pickle
+import sys
+import tempfile
+import time
 import requests
+import urllib3
 import urllib.parse
 import argparse
+import concurrent.futures
+import itertools
 import graphviz
 from atlassian import Confluence
-from typing import Optional, Generator, Tuple
+from typing import Optional, Generator, Tuple, Iterable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+import catalogue  # noqa: E402
+import jsonstream  # noqa: E402
+
+OUTPUT_DIR = 'output'
+
+TYPES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "types")
+
+# Name of the local type definitions in --compare reports
+LOCAL_TYPES = 'types'
+
+# (connect, read) timeout in seconds for each request to the act instance
+DEFAULT_TIMEOUT = (5.0, 60.0)
+DEFAULT_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+# Responses that are worth retrying, since the instance may recover
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+STATE_VERSION = 2
+
+# (fact type, source object type, destination object type or None, bidirectional)
+Binding = Tuple[str, str, Optional[str], bool]
+
+# ('node', name, label, shape) or ('edge', tail, head, label)
+Statement = Tuple[str, str, Optional[str], Optional[str]]
 
 
 class DataModel:
@@ -19,59 +54,100 @@ class DataModel:
                  url: str,
                  username: Optional[str] = None,
                  password: Optional[str] = None,
-                 user_id: int = 0) -> None:
+                 user_id: int = 0,
+                 session: Optional[requests.Session] = None,
+                 timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+                 retries: int = DEFAULT_RETRIES) -> None:
         self.objects_url = urllib.parse.urljoin(url, "/v1/objectType")
         self.facts_url = urllib.parse.urljoin(url, "/v1/factType")
         self.username = username
         self.password = password
         self.user_id = user_id
+        self.session = session or pooled_session()
+        self.timeout = timeout
+        self.retries = retries
         self.status: Optional[int] = None
+        self.error: Optional[str] = None
+        self.errors: Dict[str, str] = {}
         self._objects: Optional[dict] = None
         self._facts: Optional[dict] = None
 
-    def load(self) -> None:
-        """Download the datamodel from the act instance"""
+    def fetch(self, url: str) -> Tuple[Optional[int], Optional[dict], Optional[str]]:
+        """
+        Get the types at url, parsing the data array while it is downloaded.
+        Connection errors, RETRY_STATUS responses and bodies that can not be
+        read share one budget of retries, with exponential backoff, so there
+        are at most retries + 1 requests. Returns (status code, {'data': types},
+        None), or (status code or None, None, error) if the request failed.
+        """
 
         headers = {
             'ACT-User-ID': str(self.user_id),
             'Accept': 'application/json'
         }
-        auth = (self.username, self.password)
+        auth = (self.username, self.password) if self.username else None
+        status, error = None, None
 
-        if self.username:
-            r = requests.get(self.objects_url, auth=auth, headers=headers)
-        else:
-            r = requests.get(self.objects_url, headers=headers)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(BACKOFF_FACTOR * 2 ** (attempt - 1))
+
+            try:
+                with self.session.get(url, auth=auth, headers=headers, timeout=self.timeout, stream=True) as r:
+                    status, error = r.status_code, None
+
+                    if status == 200:
+                        r.raw.decode_content = True
+                        return status, {'data': list(jsonstream.iter_array(r.raw, 'data'))}, None
+
+                    if status not in RETRY_STATUS:
+                        return status, None, None
+
+            # Connection lost or timeout, before or while the body is read
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                status, error = None, "{}: {}".format(url, e)
+
+            # Invalid url and other errors that will not go away
+            except requests.exceptions.RequestException as e:
+                return None, None, "{}: {}".format(url, e)
+
+            # Truncated json, or the connection lost inside the json parser
+            except (urllib3.exceptions.HTTPError, ValueError) as e:
+                status, error = None, "{}: {}".format(url, e)
 
-        if r.status_code == 200:
-            self._objects = r.json()
-        else:
             if self.DEBUG:
-                print("Error loading objects: {}".format(r.status_code))
-            self._objects = None
-            self._facts = None
-            self.status = r.status_code
-            return
+                print("Error loading {} (attempt {}): {}".format(url, attempt + 1, error or status))
 
-        if self.username:
-            r = requests.get(self.facts_url, auth=auth, headers=headers)
-        else:
-            r = requests.get(self.facts_url, headers=headers)
+        return status, None, error
 
-        if r.status_code == 200:
-            self._facts = r.json()
-        else:
+    def load(self) -> None:
+        """Download the datamodel from the act instance, object and fact types concurrently"""
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            results = dict(zip([self.objects_url, self.facts_url],
+                               executor.map(self.fetch, [self.objects_url, self.facts_url])))
+
+        (objects_status, objects, _), (facts_status, facts, _) = results.values()
+
+        # One error per url, reported in the same order however the requests completed
+        self.errors = {url: error for url, (_, _, error) in results.items() if error}
+        self.error = "; ".join(self.errors.values()) or None
+
+        if objects is None or facts is None:
             if self.DEBUG:
-                print("Error loading objects: {}".format(r.status_code))
+                print("Error loading {}: {}".format(
+                    "objects" if objects is None else "facts",
+                    objects_status if objects is None else facts_status))
             self._objects = None
             self._facts = None
-            self.status = r.status_code
+            self.status = objects_status if objects is None else facts_status
             return
 
-        self.status = r.status_code
-
-    def __eq__(self, other: object) -> bool:
-        return set(self.objects) == set(other.objects) and set(self.facts) == set(other.facts)
+        self._objects = objects
+        self._facts = facts
+        self.status = facts_status
 
     @property
     def facts(self) -> Generator[Tuple[str, str, str, bool], None, None]:
@@ -110,11 +186,334 @@ class DataModel:
             yield obj['name']
 
 
+def pooled_session(pool_size: int = 2) -> requests.Session:
+    """
+    Keep-alive session with room for pool_size concurrent connections per
+    instance. Failed requests are retried by DataModel.fetch, not by the
+    session, so that reading the body shares the same retries.
+    """
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class EdgeTable:
+    """Object types and fact bindings of a data model, materialized once and indexed"""
+
+    def __init__(self, objects: Iterable[str], facts: Iterable[Binding]) -> None:
+        self.objects = list(objects)
+        self.bindings = list(facts)
+
+        self.object_set = set(self.objects)
+        self.binding_set = set(self.bindings)
+
+        # Bindings between two objects, and bindings to a single object
+        self.double = [binding for binding in self.bindings if binding[2]]
+        self.single = [binding for binding in self.bindings if not binding[2]]
+
+    @classmethod
+    def from_datamodel(cls, dm: DataModel) -> 'EdgeTable':
+        return cls(dm.objects, dm.facts)
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'EdgeTable':
+        return cls(state['objects'], [tuple(binding) for binding in state['bindings']])
+
+    def canonical(self) -> Tuple[List[str], List[Binding]]:
+        """Unique object types and fact bindings, sorted"""
+
+        return sorted(self.object_set), sort_bindings(self.binding_set)
+
+    def fingerprint(self) -> str:
+        """Hash of the sorted object types and fact bindings"""
+
+        return digest(self.canonical())
+
+
+def sort_bindings(bindings: Iterable[Binding]) -> List[Binding]:
+    return sorted(bindings, key=lambda binding: (binding[0], binding[1], binding[2] or '', binding[3]))
+
+
+def digest(value: object) -> str:
+    """sha256 of value as compact json"""
+
+    return hashlib.sha256(json.dumps(value, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def node(name: str, shape: Optional[str] = None) -> Statement:
+    return ('node', name, name, shape)
+
+
+def edge(tail: str, head: str, label: Optional[str] = None) -> Statement:
+    return ('edge', tail, head, label)
+
+
+def double_view(table: EdgeTable) -> List[Statement]:
+    """Facts between two objects, except mentions"""
+
+    statements = []
+
+    for name, s, d, di in table.double:
+        if name == 'mentions':
+            continue
+
+        statements += [node(s), node(d), edge(s, d, name)]
+        if di:
+            statements.append(edge(s, d, name))
+
+    return statements
+
+
+def single_view(table: EdgeTable) -> List[Statement]:
+    """Facts with a single object"""
+
+    statements = []
+
+    for name, s, _, _ in table.single:
+        statements += [node(name, shape='diamond'), node(s), edge(name, s)]
+
+    return statements
+
+
+def complete_view(table: EdgeTable) -> List[Statement]:
+    """All objects, and all facts between two objects"""
+
+    statements = [node(obj) for obj in table.objects]
+
+    for name, s, d, di in table.double:
+        statements += [node(s), node(d), edge(s, d, name)]
+        if di and not s == d:
+            statements.append(edge(s, d, name))
+
+    return statements
+
+
+# view -> (graph comment, confluence attachment title, statements of view)
+VIEWS = {
+    'double': ('Double edge facts', 'Double Edged Facts', double_view),
+    'single': ('Single edge facts', 'Single Edged Facts', single_view),
+    'complete': ('All Double edge facts', 'Single Edged Facts', complete_view),
+}
+
+
+def image_path(view: str) -> str:
+    return os.path.join(OUTPUT_DIR, '{}.cairo.png'.format(view))
+
+
+def render_view(view: str, statements: List[Statement]) -> str:
+    """Render the statements of view to png (runs in a worker process)"""
+
+    dot = graphviz.Digraph(comment=VIEWS[view][0])
+
+    for kind, a, b, c in statements:
+        if kind == 'node' and c:
+            dot.node(a, label=b, shape=c)
+        elif kind == 'node':
+            dot.node(a, b)
+        else:
+            dot.edge(a, b, label=c)
+
+    return dot.render(os.path.join(OUTPUT_DIR, view), format='png', renderer='cairo')
+
+
+def view_digest(statements: List[Statement]) -> str:
+    """
+    Hash of the statements of a view, independent of their order. Duplicates
+    are kept, since bidirectional bindings are drawn as two edges.
+    """
+
+    return digest(sorted(statements, key=repr))
+
+
+def changed_views(old: Dict[str, str], new: Dict[str, str]) -> List[str]:
+    """Views whose digest differs from the previous run, or that are not rendered yet"""
+
+    return [view for view in VIEWS
+            if old.get(view) != new[view] or not os.path.exists(image_path(view))]
+
+
+def render_views(statements: Dict[str, List[Statement]], views: List[str]) -> None:
+    """Render views concurrently, one process per view"""
+
+    if not views:
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(views)) as executor:
+        for path in executor.map(render_view, views, [statements[view] for view in views]):
+            print("{} Rendered {}".format(str(datetime.datetime.now()), path))
+
+
+def snapshot_path(filename: str) -> str:
+    """Object types and bindings of the previous run are kept next to the state file"""
+
+    return '{}.snapshot{}'.format(*os.path.splitext(filename))
+
+
+def load_state(filename: str) -> Optional[dict]:
+    """Fingerprint and view digests from the previous run"""
+
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print("Ignoring invalid state file {}".format(filename))
+        return None
+
+    if state.get('version') != STATE_VERSION:
+        return None
+
+    return state
+
+
+def load_snapshot(filename: str) -> Optional[EdgeTable]:
+    """Object types and bindings from the previous run, only read when the fingerprint has changed"""
+
+    try:
+        with open(snapshot_path(filename)) as f:
+            return EdgeTable.from_state(json.load(f))
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print("Ignoring invalid snapshot {}".format(snapshot_path(filename)))
+        return None
+
+
+def write_json(filename: str, value: dict) -> None:
+    """Write value atomically"""
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f, indent=1)
+    os.replace(tmp, filename)
+
+
+def save_state(filename: str, fingerprint: str, table: EdgeTable, views: Dict[str, str]) -> None:
+    """Write the snapshot, then the state that refers to it"""
+
+    objects, bindings = table.canonical()
+
+    write_json(snapshot_path(filename), {'objects': objects, 'bindings': bindings})
+    write_json(filename, {'version': STATE_VERSION, 'fingerprint': fingerprint, 'views': views})
+
+
+def difference(a: EdgeTable, b: EdgeTable) -> dict:
+    """Object types and bindings in a that are not in b"""
+
+    return {'objectTypes': sorted(a.object_set - b.object_set),
+            'bindings': sort_bindings(a.binding_set - b.binding_set)}
+
+
+def diff(old: Optional[EdgeTable], table: EdgeTable) -> dict:
+    """Object types and bindings added and removed since the previous run"""
+
+    old = old or EdgeTable([], [])
+
+    return {'added': difference(table, old), 'removed': difference(old, table)}
+
+
+def load_local_types(types_dir: str = TYPES_DIR) -> EdgeTable:
+    """Object types and fact bindings in the type catalogue of types_dir"""
+
+    types = catalogue.load_dir(types_dir)
+    bindings = []
+
+    for name, fact_bindings in types.bindings.items():
+        # Fact types without objectBindings are bound to all object types
+        if fact_bindings is None:
+            fact_bindings = itertools.product(types.object_types, types.object_types, [True, False])
+
+        bindings += [(name, s, d, di) for s, d, di in fact_bindings]
+
+    return EdgeTable(types.object_types, bindings)
+
+
+def load_instances(urls: List[str], args: argparse.Namespace) -> Dict[str, DataModel]:
+    """Load the data models of all instances concurrently"""
+
+    models = {url: DataModel(url, args.http_username, args.http_password, args.uid,
+                             timeout=(DEFAULT_TIMEOUT[0], args.timeout), retries=args.retries)
+              for url in urls}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(models)) as executor:
+        futures = {executor.submit(dm.load): dm for dm in models.values()}
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                # Reported as an instance that could not be loaded, like a failed request
+                futures[future].status = None
+                futures[future].error = "Unexpected error: {!r}".format(e)
+
+    return models
+
+
+def compare(models: Dict[str, DataModel], local: EdgeTable) -> dict:
+    """
+    Divergence of each instance from the local type definitions, and a matrix
+    of the number of object types and bindings in each source (row) that are
+    missing from each other source (column)
+    """
+
+    tables = {LOCAL_TYPES: local}
+    instances = {}
+
+    for url, dm in models.items():
+        if dm.status != 200:
+            instances[url] = {'status': dm.status, 'error': dm.error}
+            continue
+
+        tables[url] = table = EdgeTable.from_datamodel(dm)
+        instances[url] = {
+            'status': dm.status,
+            'fingerprint': table.fingerprint(),
+            'missing': difference(local, table),
+            'extra': difference(table, local),
+        }
+        instances[url]['matches'] = not any(itertools.chain(
+            instances[url]['missing'].values(), instances[url]['extra'].values()))
+
+    matrix: Dict[str, Dict[str, dict]] = {}
+
+    for a, b in itertools.product(tables, tables):
+        matrix.setdefault(a, {})[b] = {
+            'objectTypes': len(tables[a].object_set - tables[b].object_set),
+            'bindings': len(tables[a].binding_set - tables[b].binding_set),
+        }
+
+    return {
+        'time': datetime.datetime.now().isoformat(),
+        'fingerprint': {source: table.fingerprint() for source, table in tables.items()},
+        'instances': instances,
+        'matrix': matrix,
+        'divergent': [url for url, instance in instances.items() if not instance.get('matches')],
+    }
+
+
+def log_changes(filename: str, url: str, state: Optional[dict], old: Optional[EdgeTable],
+                table: EdgeTable, fingerprint: str) -> None:
+    """Append the changes since the previous run to the change log (one json object per line)"""
+
+    with open(filename, 'a') as f:
+        f.write(json.dumps(dict(time=datetime.datetime.now().isoformat(),
+                                url=url,
+                                previous=state['fingerprint'] if state else None,
+                                fingerprint=fingerprint,
+                                **diff(old, table))) + '\n')
+
+
 def parse_args() -> argparse.Namespace:
     """Handle command line arguments, returning the arguments ns"""
 
     parser = argparse.ArgumentParser(description="Build a graph of the act datamodel")
-    parser.add_argument('url', type=str, help="Url of the act instance to graph")
+    parser.add_argument('url', type=str, nargs='+',
+                        help="Url of the act instance to graph, or of the instances to --compare")
     parser.add_argument('--uid', default=1, type=int, help="Act user ID")
     parser.add_argument('--http_username', type=str, default=None, help="HTTP Username")
     parser.add_argument('--http_password', type=str, default=None, help="HTTP Password")
@@ -122,96 +521,93 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--confluence_url', type=str, default=None, help="Confluence api url")
     parser.add_argument('--confluence_user', type=str, default=None, help="Confluence user")
     parser.add_argument('--confluence_password', type=str, default=None, help="Confluence password")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT[1],
+                        help="Timeout in seconds for reading each response")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help="Retries, with exponential backoff, of failed requests")
+    parser.add_argument('--state_file', type=str, default='datamodel.json',
+                        help="Fingerprint of the previous run (its bindings are kept next to it, in <name>.snapshot.json)")
+    parser.add_argument('--change_log', type=str, default='datamodel-changes.jsonl',
+                        help="Log of added and removed types and bindings (json lines)")
+    parser.add_argument('--compare', action='store_true',
+                        help="Compare the data models of the instances with the local type definitions")
+    parser.add_argument('--types_dir', type=str, default=TYPES_DIR,
+                        help="Local type definitions for --compare")
+    parser.add_argument('--report', type=str, default=None,
+                        help="Write the --compare report to file (default = stdout)")
 
-    return parser.parse_args()
-
-
-def run() -> None:
-    """Main program loop"""
-
-    args = parse_args()
+    args = parser.parse_args()
 
-    dm = DataModel(args.url, args.http_username, args.http_password, args.uid)
-    dm.load()
+    if len(args.url) > 1 and not args.compare:
+        parser.error("Only one instance can be graphed, use --compare for several instances")
 
-    if dm.status != 200:
-        print("{} Status code {}".format(str(datetime.datetime.now()), dm.status))
-        return
+    return args
 
-    try:
-        old_dm = pickle.load(open('cache.dat', 'rb'))
-        if old_dm == dm:
-            return
-    except FileNotFoundError:
-        print("First run")
 
-    print("{} Graphing changes".format(str(datetime.datetime.now())))
+def run_compare(args: argparse.Namespace) -> bool:
+    """Write the comparison report, return True if all instances match the local types"""
 
-    pickle.dump(dm, open('cache.dat', 'wb'))
+    report = compare(load_instances(args.url, args), load_local_types(args.types_dir))
 
-    dot = graphviz.Digraph(comment='Double edge facts')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
 
-    # for obj in dm.objects:
-    #     dot.node(obj, obj)
+    return not report['divergent']
 
-    for fact in dm.facts:
-        name, s, d, di = fact
-        if name == 'mentions':
-            continue
-        if not d:
-            continue
 
-        dot.node(s, s)
-        dot.node(d, d)
-        dot.edge(s, d, label=name)
-        if di:
-            dot.edge(s, d, label=name)
+def run() -> None:
+    """Main program loop"""
 
-    dot.render('output/double', format='png', renderer='cairo')
+    args = parse_args()
 
-    dot = graphviz.Digraph(comment='Single edge facts')
+    if args.compare:
+        sys.exit(0 if run_compare(args) else 1)
 
-    for fact in dm.facts:
+    url = args.url[0]
 
-        name, s, d, di = fact
+    dm = DataModel(url, args.http_username, args.http_password, args.uid,
+                   timeout=(DEFAULT_TIMEOUT[0], args.timeout), retries=args.retries)
+    dm.load()
 
-        if d:
-            continue
+    if dm.status != 200:
+        print("{} Status code {}{}".format(str(datetime.datetime.now()), dm.status,
+                                           ": {}".format(dm.error) if dm.error else ""))
+        return
 
-        dot.node(name, label=name, shape='diamond')
-        dot.node(s, s)
+    table = EdgeTable.from_datamodel(dm)
+    fingerprint = table.fingerprint()
+    state = load_state(args.state_file)
 
-        dot.edge(name, s)
+    if state and state['fingerprint'] == fingerprint:
+        return
 
-    dot.render('output/single', format='png', renderer='cairo')
+    if not state:
+        print("First run")
 
-    dot = graphviz.Digraph(comment='All Double edge facts')
+    log_changes(args.change_log, url, state, load_snapshot(args.state_file) if state else None, table, fingerprint)
 
-    for obj in dm.objects:
-        dot.node(obj, obj)
+    statements = {view: view_statements(table) for view, (_, _, view_statements) in VIEWS.items()}
+    digests = {view: view_digest(statements[view]) for view in VIEWS}
+    views = changed_views(state['views'] if state else {}, digests)
 
-    for fact in dm.facts:
-        name, s, d, di = fact
-        if not d:
-            continue
+    print("{} Graphing changes: {}".format(str(datetime.datetime.now()), ", ".join(views) or "none"))
 
-        dot.node(s, s)
-        dot.node(d, d)
-        dot.edge(s, d, label=name)
-        if di and not s == d:
-            dot.edge(s, d, label=name)
+    render_views(statements, views)
 
-    dot.render('output/complete', format='png', renderer='cairo')
+    # Saved after rendering, so views that failed to render are retried
+    save_state(args.state_file, fingerprint, table, digests)
 
-    if args.parent_id:
+    if args.parent_id and views:
         os.environ.pop('https_proxy')
         os.environ.pop('http_proxy')
         confluence = Confluence(url=args.confluence_url,
                                 username=args.confluence_user,
                                 password=args.confluence_password)
-        confluence.attach_file('output/double.cairo.png', page_id=args.parent_id, title='Double Edged Facts')
-        confluence.attach_file('output/single.cairo.png', page_id=args.parent_id, title='Single Edged Facts')
-        confluence.attach_file('output/complete.cairo.png', page_id=args.parent_id, title='Single Edged Facts')
+        for view in views:
+            confluence.attach_file(image_path(view), page_id=args.parent_id, title=VIEWS[view][1])
 
 
 if __name__ == '__main__':
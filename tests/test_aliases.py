@@ -0,0 +1,96 @@
+""" Tests of AliasGraph in bootstrap/aliases.py: unique pairs and clusters of aliases """
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+import aliases  # noqa: E402
+
+
+class Fact(object):
+    def __init__(self, fact_type):
+        self.fact_type = fact_type
+
+    def bidirectional(self, source_type, source_value, destination_type, destination_value):
+        return (self.fact_type, source_type, source_value, destination_type, destination_value)
+
+
+class Client(object):
+    def fact(self, fact_type):
+        return Fact(fact_type)
+
+
+class Submitter(object):
+    """ Submitter that records the facts submitted """
+
+    def __init__(self):
+        self.client = Client()
+        self.facts = []
+
+    def submit(self, fact):
+        self.facts.append(fact)
+
+
+def graph(*adds):
+    alias_graph = aliases.AliasGraph()
+
+    for args in adds:
+        alias_graph.add(*args)
+
+    return alias_graph
+
+
+@pytest.mark.parametrize("adds, facts", [
+    # Each pair is submitted once, in sorted order, whichever direction it was added in
+    ([("alias", "tool", "b", ["a"]), ("alias", "tool", "a", "b"), ("alias", "tool", "a", ["b", "b"])],
+     [("alias", "tool", "a", "tool", "b")]),
+    # Self aliases are skipped
+    ([("alias", "tool", "a", ["a", "c"])],
+     [("alias", "tool", "a", "tool", "c")]),
+    ([("alias", "tool", "a", "a"), ("alias", "tool", "a", [])],
+     []),
+    # Pairs of other fact and object types are kept apart
+    ([("alias", "threatActor", "x", "y"), ("alias", "tool", "x", "y"), ("similar", "tool", "y", "x")],
+     [("alias", "threatActor", "x", "threatActor", "y"),
+      ("alias", "tool", "x", "tool", "y"),
+      ("similar", "tool", "x", "tool", "y")]),
+])
+def test_submit(adds, facts):
+    alias_graph = graph(*adds)
+    submitter = Submitter()
+
+    alias_graph.submit(submitter)
+
+    assert submitter.facts == facts
+    assert len(alias_graph) == len(facts)
+
+
+@pytest.mark.parametrize("adds, clusters", [
+    ([], []),
+    ([("alias", "tool", "a", "a")], []),
+    # Clusters are merged when an alias connects them
+    ([("alias", "tool", "d", "c"), ("alias", "tool", "a", "b"), ("alias", "tool", "b", "c")],
+     [("alias", "tool", ["a", "b", "c", "d"])]),
+    ([("alias", "tool", "a", ["b", "c"]), ("alias", "tool", "x", "y"), ("alias", "tool", "c", "a")],
+     [("alias", "tool", ["a", "b", "c"]), ("alias", "tool", ["x", "y"])]),
+    # The same value of other fact or object types is in another cluster
+    ([("alias", "tool", "a", "b"), ("alias", "threatActor", "b", "c"), ("similar", "tool", "b", "c")],
+     [("alias", "threatActor", ["b", "c"]), ("alias", "tool", ["a", "b"]), ("similar", "tool", ["b", "c"])]),
+])
+def test_clusters(adds, clusters):
+    assert graph(*adds).clusters() == [
+        {"factType": fact_type, "objectType": object_type, "values": values}
+        for (fact_type, object_type, values) in clusters]
+
+
+def test_write_clusters(tmp_path):
+    filename = str(tmp_path / "clusters.json")
+
+    graph(("alias", "tool", "b", "a")).write_clusters(filename)
+
+    with open(filename) as f:
+        assert json.load(f) == [{"factType": "alias", "objectType": "tool", "values": ["a", "b"]}]
@@ -0,0 +1,85 @@
+""" Tests of bootstrap/checkpoint.py: resume, instance mismatch and failed facts """
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+import checkpoint  # noqa: E402
+
+INSTANCE = "http://act.local"
+
+
+def commit(progress, *keys):
+    """ Mark and commit keys, as the submitter does when a batch is sent """
+    for key in keys:
+        assert not progress.done(key)
+        progress.mark(key)
+
+    progress.commit(progress.prepare())
+
+
+def test_resume(tmp_path):
+    filename = str(tmp_path / "checkpoint.jsonl")
+
+    commit(checkpoint.Checkpoint(filename, INSTANCE), "row/1", "row/2")
+
+    progress = checkpoint.Checkpoint(filename, INSTANCE, resume=True)
+    assert progress.done("row/1")
+    assert progress.done("row/2")
+    assert not progress.done("row/3")
+
+    # The keys of the previous run are kept if this run fails too
+    commit(progress, "row/3")
+    assert checkpoint.Checkpoint(filename, INSTANCE, resume=True).completed == {"row/1", "row/2", "row/3"}
+
+
+def test_no_resume(tmp_path):
+    filename = str(tmp_path / "checkpoint.jsonl")
+
+    commit(checkpoint.Checkpoint(filename, INSTANCE), "row/1")
+
+    assert not checkpoint.Checkpoint(filename, INSTANCE).done("row/1")
+
+
+def test_other_instance(tmp_path):
+    filename = str(tmp_path / "checkpoint.jsonl")
+
+    commit(checkpoint.Checkpoint(filename, INSTANCE), "row/1")
+
+    assert checkpoint.Checkpoint(filename, "http://other.local", resume=True).completed == set()
+
+
+def test_partial_last_line(tmp_path):
+    filename = str(tmp_path / "checkpoint.jsonl")
+
+    commit(checkpoint.Checkpoint(filename, INSTANCE), "row/1")
+
+    with open(filename, "a") as f:
+        f.write('"row/')
+
+    assert checkpoint.Checkpoint(filename, INSTANCE, resume=True).completed == {"row/1"}
+
+
+def test_failed_facts(tmp_path):
+    progress = checkpoint.Checkpoint(str(tmp_path / "checkpoint.jsonl"), INSTANCE)
+
+    for (key, facts) in (("a", ["fact/1", "fact/2"]), ("b", ["fact/3"]), ("c", [])):
+        assert not progress.done(key)
+        for fact in facts:
+            progress.record(fact)
+        progress.mark(key)
+
+    progress.commit(progress.prepare(), failed={"fact/2"})
+
+    assert progress.completed == {"b", "c"}
+
+
+def test_finish(tmp_path):
+    filename = str(tmp_path / "checkpoint.jsonl")
+    progress = checkpoint.Checkpoint(filename, INSTANCE)
+
+    commit(progress, "row/1")
+    progress.finish()
+
+    assert not os.path.exists(filename)
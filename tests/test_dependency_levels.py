@@ -0,0 +1,88 @@
+""" Tests of dependency_levels in bootstrap/act-bootstrap.py: creation order of the planned types """
+
+import importlib
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+act_bootstrap = importlib.import_module("act-bootstrap")  # noqa: E402
+
+
+def plan(object_types=(), fact_types=None, object_bindings=None, meta_fact_types=None, fact_bindings=None):
+    """
+    Plan from type names, (source, destination) object type names of fact types and
+    fact type names of meta fact types. Types with object_bindings or fact_bindings exist.
+    """
+    result = act_bootstrap.Plan()
+
+    result.object_types = [{"name": name} for name in object_types]
+    result.fact_types = [({"name": name}, {(source, destination, False) for (source, destination) in bindings})
+                         for (name, bindings) in (fact_types or {}).items()]
+    result.object_bindings = [(SimpleNamespace(name=name),
+                               {(source, destination, False) for (source, destination) in bindings})
+                              for (name, bindings) in (object_bindings or {}).items()]
+    result.meta_fact_types = [({"name": name}, set(bindings))
+                              for (name, bindings) in (meta_fact_types or {}).items()]
+    result.fact_bindings = [(SimpleNamespace(name=name), set(bindings))
+                            for (name, bindings) in (fact_bindings or {}).items()]
+
+    return result
+
+
+def name(kind, item):
+    if kind == "objectType":
+        return item["name"]
+
+    (fact_type, _) = item
+    return fact_type["name"] if kind in ("factType", "metaFactType") else fact_type.name
+
+
+def names(levels):
+    """ Sorted (kind, name) of the changes at each level """
+    return [sorted((kind, name(kind, item)) for (kind, item) in level) for level in levels]
+
+
+@pytest.mark.parametrize("changes, levels", [
+    ({}, []),
+    # Fact types bound to existing object types do not wait for new object types
+    ({"object_types": ["tool"],
+      "fact_types": {"uses": [("threatActor", "tool")], "alias": [("threatActor", "threatActor")]}},
+     [[("factType", "alias"), ("objectType", "tool")],
+      [("factType", "uses")]]),
+    # Meta fact types wait for the fact types they are bound to, also meta fact types
+    ({"object_types": ["tool"],
+      "fact_types": {"uses": [("tool", "tool")]},
+      "meta_fact_types": {"observationTime": ["uses", "mentions"], "comment": ["observationTime"]}},
+     [[("objectType", "tool")],
+      [("factType", "uses")],
+      [("metaFactType", "observationTime")],
+      [("metaFactType", "comment")]]),
+    # New bindings of existing types wait for new types too
+    ({"object_types": ["content"],
+      "object_bindings": {"mentions": [("report", "content")]},
+      "fact_bindings": {"observationTime": ["mentions"], "comment": ["uses"]}},
+     [[("factBindings", "comment"), ("objectType", "content")],
+      [("objectBindings", "mentions")],
+      [("factBindings", "observationTime")]]),
+    # A meta fact type bound to itself does not depend on itself
+    ({"fact_types": {"uses": [("tool", "tool")]},
+      "meta_fact_types": {"comment": ["comment", "uses"]}},
+     [[("factType", "uses")],
+      [("metaFactType", "comment")]]),
+])
+def test_levels(changes, levels):
+    assert names(act_bootstrap.dependency_levels(plan(**changes))) == levels
+
+
+@pytest.mark.parametrize("changes", [
+    {"meta_fact_types": {"observationTime": ["comment"], "comment": ["observationTime"]}},
+    {"meta_fact_types": {"a": ["b"], "b": ["c"]},
+     "fact_bindings": {"c": ["a"]}},
+])
+def test_circular_bindings(changes):
+    with pytest.raises(SystemExit):
+        act_bootstrap.dependency_levels(plan(**changes))
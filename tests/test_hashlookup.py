@@ -0,0 +1,100 @@
+""" Tests of bootstrap/hashlookup.py, compiling md5,sha256 CSV files to lookup files """
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+import hashlookup  # noqa: E402
+
+
+def md5(n):
+    return "%032x" % n
+
+
+def sha256(n):
+    return "%064x" % n
+
+
+def write_csv(filename, pairs):
+    with open(filename, "w") as f:
+        for (md5_value, sha256_value) in pairs:
+            f.write("%s,%s\n" % (md5_value, sha256_value))
+
+
+@pytest.fixture(params=[2, hashlookup.RUN_SIZE], ids=["runs", "one run"])
+def run_size(request, monkeypatch):
+    """ Compile with several sorted runs, and with one """
+    monkeypatch.setattr(hashlookup, "RUN_SIZE", request.param)
+
+
+def compiled(tmp_path, pairs):
+    csv_filename = str(tmp_path / "lookup.csv")
+    write_csv(csv_filename, pairs)
+    hashlookup.compile_lookup(csv_filename, str(tmp_path / "lookup.md5"))
+    return hashlookup.HashLookup(str(tmp_path / "lookup.md5"))
+
+
+def test_get(tmp_path, run_size):
+    lookup = compiled(tmp_path, [(md5(n), sha256(n * 10)) for n in (5, 1, 9, 3, 7)])
+
+    assert len(lookup) == 5
+    assert lookup.get(md5(1)) == sha256(10)  # First record
+    assert lookup.get(md5(9)) == sha256(90)  # Last record
+    assert lookup.get(md5(5)) == sha256(50)
+    assert lookup.get(md5(4)) is None
+    assert lookup.get(md5(0)) is None
+    assert lookup.get(md5(10), "default") == "default"
+    assert lookup.get("not hex") is None
+
+
+def test_duplicate_md5(tmp_path, run_size):
+    # The last sha256 in the file is kept, as when the file was read into a dict
+    lookup = compiled(tmp_path, [(md5(2), sha256(3)), (md5(1), sha256(1)), (md5(2), sha256(9)),
+                                 (md5(2), sha256(5)), (md5(4), sha256(4))])
+
+    assert len(lookup) == 3
+    assert lookup.get(md5(2)) == sha256(5)
+
+
+def test_invalid_lines(tmp_path):
+    lookup = compiled(tmp_path, [(md5(1), sha256(1)), ("xyz", sha256(2)), (md5(3), "")])
+
+    assert len(lookup) == 1
+    assert lookup.get(md5(1)) == sha256(1)
+
+
+def test_empty(tmp_path):
+    lookup = compiled(tmp_path, [])
+
+    assert len(lookup) == 0
+    assert lookup.get(md5(1)) is None
+
+
+def test_rebuild_after_change(tmp_path):
+    csv_filename = str(tmp_path / "lookup.csv")
+    index_dir = str(tmp_path / "index")
+
+    write_csv(csv_filename, [(md5(1), sha256(1))])
+    assert hashlookup.open_lookup(csv_filename, index_dir).get(md5(1)) == sha256(1)
+
+    compiled_filename = hashlookup.index_filename(csv_filename, index_dir)
+    mtime = os.path.getmtime(compiled_filename)
+
+    # Not compiled again while the CSV file is unchanged
+    assert hashlookup.open_lookup(csv_filename, index_dir).get(md5(1)) == sha256(1)
+    assert os.path.getmtime(compiled_filename) == mtime
+
+    write_csv(csv_filename, [(md5(1), sha256(2))])
+    os.utime(csv_filename, (mtime + 10, mtime + 10))
+
+    assert hashlookup.open_lookup(csv_filename, index_dir).get(md5(1)) == sha256(2)
+
+
+def test_open_compiled(tmp_path):
+    compiled(tmp_path, [(md5(1), sha256(1))])
+
+    assert hashlookup.open_lookup(str(tmp_path / "lookup.md5"), str(tmp_path / "index")).get(md5(1)) == sha256(1)
+    assert not os.path.exists(str(tmp_path / "index"))
@@ -0,0 +1,87 @@
+""" Tests of bootstrap/jsonstream.py, with documents split at every offset """
+
+import io
+import itertools
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+import jsonstream  # noqa: E402
+
+DOCUMENTS = [
+    '{"values": [1.5, -2.25e-3, 3E+2, 0, -0.0, 10, 123456.789]}',
+    '{"values": [-1, 2e5, 1.0e-10, 42]}',
+    '{"a": {"b": [1, 2]}, "values": [{"x": "y"}, "æøå \\u00e5", true, false, null], "c": 1.25}',
+    '{"values": []}',
+    '{"values": [[1.5], [], {"k": [2.5, "3.5"]}]}',
+    '{}',
+    ' {"n": 12.5 , "values" : [ 1 , 2.5 ] } \n',
+]
+
+
+class SplitFile(object):
+    """ Binary file that returns data in the given parts, however much is asked for """
+
+    def __init__(self, parts):
+        self.parts = [part for part in parts if part]  # An empty read is end of file
+
+    def read(self, size=-1):
+        return self.parts.pop(0) if self.parts else b""
+
+
+def splits(document):
+    """ The document (utf8) split in two at every offset """
+    data = document.encode("utf8")
+    for offset in range(len(data) + 1):
+        yield SplitFile([data[:offset], data[offset:]])
+
+
+class ChunkFile(io.BytesIO):
+    """ Binary file that returns at most chunk_size bytes per read """
+
+    def __init__(self, data, chunk_size):
+        super().__init__(data)
+        self.chunk_size = chunk_size
+
+    def read(self, size=-1):
+        return super().read(self.chunk_size)
+
+
+def chunks(document):
+    """ The document (utf8) read with every chunk size """
+    data = document.encode("utf8")
+    for chunk_size in range(1, len(data) + 2):
+        yield ChunkFile(data, chunk_size)
+
+
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_iter_items(document):
+    expected = list(json.loads(document).items())
+
+    for f in itertools.chain(splits(document), chunks(document)):
+        assert list(jsonstream.iter_items(f)) == expected
+
+
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_iter_array(document):
+    expected = json.loads(document).get("values", [])
+
+    for f in itertools.chain(splits(document), chunks(document)):
+        assert list(jsonstream.iter_array(f, "values")) == expected
+
+
+@pytest.mark.parametrize("document", ["[1.5, 2]", "1.5", "-12e3", '"text"', "true"])
+def test_value_split(document):
+    for f in splits(document):
+        assert jsonstream.Reader(f).value() == json.loads(document)
+
+
+@pytest.mark.parametrize("document", ['{"values": [1, 2]} x', '{"values": [1, 2] ', '{"values": [1 2]}'])
+def test_invalid(document):
+    for f in splits(document):
+        with pytest.raises(json.JSONDecodeError):
+            list(jsonstream.iter_array(f, "values"))
@@ -0,0 +1,121 @@
+""" Tests of reconcile in bootstrap/act-bootstrap.py, with a stub client holding the existing types """
+
+import importlib
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+act_bootstrap = importlib.import_module("act-bootstrap")  # noqa: E402
+
+
+def object_binding(source, destination, bidirectional=False):
+    return SimpleNamespace(source_object_type=SimpleNamespace(name=source),
+                           destination_object_type=SimpleNamespace(name=destination),
+                           bidirectional_binding=bidirectional)
+
+
+class Client(object):
+    """ Client with existing object types (names) and fact types (name -> object or fact bindings) """
+
+    def __init__(self, object_types=(), fact_types=None, meta_fact_types=None):
+        self.object_types = [SimpleNamespace(name=name) for name in object_types]
+        self.fact_types = \
+            [SimpleNamespace(name=name,
+                             relevant_object_bindings=[object_binding(*binding) for binding in bindings],
+                             relevant_fact_bindings=None)
+             for (name, bindings) in (fact_types or {}).items()] + \
+            [SimpleNamespace(name=name,
+                             relevant_object_bindings=None,
+                             relevant_fact_bindings=[SimpleNamespace(name=binding) for binding in bindings])
+             for (name, bindings) in (meta_fact_types or {}).items()]
+
+    def get_object_types(self):
+        return self.object_types
+
+    def get_fact_types(self):
+        return self.fact_types
+
+
+OBJECT_TYPES = [{"name": "tool"}, {"name": "threatActor"}]
+
+FACT_TYPES = [
+    {"name": "uses", "objectBindings": [{"sourceObjectType": "threatActor", "destinationObjectType": "tool"}]},
+    {"name": "alias", "objectBindings": [
+        {"sourceObjectType": ["tool", "threatActor"], "destinationObjectType": "tool", "bidirectional": True}]},
+]
+
+META_FACT_TYPES = [{"name": "observationTime", "factBindings": ["uses"]}]
+
+
+@pytest.mark.parametrize("client, plan", [
+    # Nothing exists
+    (Client(),
+     ["+ objectType tool",
+      "+ objectType threatActor",
+      "+ factType uses: threatActor -> tool",
+      "+ factType alias: threatActor <-> tool",
+      "+ factType alias: tool <-> tool",
+      "+ metaFactType observationTime: uses"]),
+    # Everything exists
+    (Client(["tool", "threatActor", "other"],
+            {"uses": [("threatActor", "tool")],
+             "alias": [("tool", "tool", True), ("threatActor", "tool", True), ("tool", "threatActor", True)]},
+            {"observationTime": ["uses", "other"]}),
+     []),
+    # Only the missing bindings are added to existing types
+    (Client(["tool"],
+            {"uses": [("threatActor", "tool", True)], "alias": [("tool", "tool", True)]},
+            {"observationTime": ["alias"]}),
+     ["+ objectType threatActor",
+      "+ factType uses: threatActor -> tool",
+      "+ factType alias: threatActor <-> tool",
+      "+ metaFactType observationTime: uses"]),
+])
+def test_plan(client, plan):
+    (result, existing_object_types, existing_fact_types) = act_bootstrap.reconcile(
+        client, OBJECT_TYPES, FACT_TYPES, META_FACT_TYPES)
+
+    assert str(result).splitlines() == plan
+    assert bool(result) == bool(plan)
+    assert set(existing_object_types) == {object_type.name for object_type in client.object_types}
+    assert set(existing_fact_types) == {fact_type.name for fact_type in client.fact_types}
+
+
+def test_default_bindings():
+    # Fact types without objectBindings are bound to all object types, and
+    # meta fact types without factBindings to all fact types that are not meta
+    (plan, _, _) = act_bootstrap.reconcile(
+        Client(["tool"], {"uses": [("tool", "tool")]}, {"observationTime": ["uses"]}),
+        [{"name": "content"}],
+        [{"name": "mentions"}],
+        [{"name": "observationTime"}, {"name": "comment"}])
+
+    assert str(plan).splitlines() == [
+        "+ objectType content",
+        "+ factType mentions: content -> content",
+        "+ factType mentions: content <-> content",
+        "+ factType mentions: content -> tool",
+        "+ factType mentions: content <-> tool",
+        "+ factType mentions: tool -> content",
+        "+ factType mentions: tool <-> content",
+        "+ factType mentions: tool -> tool",
+        "+ factType mentions: tool <-> tool",
+        "+ metaFactType comment: mentions",
+        "+ metaFactType comment: uses",
+        "+ metaFactType observationTime: mentions",
+    ]
+
+
+@pytest.mark.parametrize("fact_types, meta_fact_types", [
+    ([{"name": "uses", "objectBindings": [{"sourceObjectType": "malware", "destinationObjectType": "tool"}]}],
+     []),
+    ([],
+     [{"name": "observationTime", "factBindings": ["uses"]}]),
+])
+def test_undefined_references(fact_types, meta_fact_types):
+    with pytest.raises(SystemExit):
+        act_bootstrap.reconcile(Client(), OBJECT_TYPES, fact_types, meta_fact_types)
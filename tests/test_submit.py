@@ -0,0 +1,129 @@
+""" Tests of FactSubmitter in bootstrap/submit.py, committing checkpoints with a stub client """
+
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+import act  # noqa: E402
+import checkpoint  # noqa: E402
+import submit  # noqa: E402
+
+
+class Config(object):
+    act_baseurl = "http://act.local"
+    requests_common_kwargs = None
+
+
+class Client(object):
+    """ Client with the config FactSubmitter reads """
+
+    def __init__(self):
+        self.config = Config()
+
+
+class Type(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Fact(object):
+    """ Fact whose add() waits for release (if given), then fails or succeeds """
+
+    def __init__(self, value, fail=False, release=None):
+        self.type = Type("mentions")
+        self.value = value
+        self.source_object = None
+        self.destination_object = None
+        self.fail = fail
+        self.release = release
+        self.started = threading.Event()
+
+    def add(self):
+        self.started.set()
+
+        if self.release:
+            assert self.release.wait(10)
+
+        if self.fail:
+            raise act.base.ResponseError("Failed: %s" % self.value)
+
+    def __str__(self):
+        return "mentions %s" % self.value
+
+
+def submitter_with_checkpoint(tmp_path):
+    submitter = submit.FactSubmitter(Client(), batch_size=100)
+    progress = checkpoint.Checkpoint(str(tmp_path / "checkpoint.jsonl"), Config.act_baseurl)
+    submitter.add_checkpoint(progress)
+    return (submitter, progress)
+
+
+def submit_entity(submitter, progress, key, *facts):
+    """ Submit the facts of entity key, as the importers do """
+    assert not progress.done(key)
+
+    for fact in facts:
+        submitter.submit(fact)
+
+    progress.mark(key)
+
+
+def committed(progress):
+    """ Keys written to the checkpoint file, in order """
+    with open(progress.filename) as f:
+        return [json.loads(line) for line in f.readlines()[1:]]
+
+
+def test_commit_in_batch_order(tmp_path):
+    (submitter, progress) = submitter_with_checkpoint(tmp_path)
+    release = threading.Event()
+    slow = Fact("slow", release=release)
+
+    # The first batch is sent by another thread, and waits for release
+    submit_entity(submitter, progress, "a", slow)
+    first = threading.Thread(target=submitter.flush)
+    first.start()
+    assert slow.started.wait(10)
+
+    # The second batch completes first, but is not committed before the first
+    try:
+        submit_entity(submitter, progress, "b", Fact("fast"))
+        submitter.flush()
+        assert committed(progress) == []
+    finally:
+        release.set()
+        first.join(10)
+
+    assert committed(progress) == ["a", "b"]
+
+    submitter.close()
+
+
+def test_skip_entities_with_failed_facts(tmp_path):
+    (submitter, progress) = submitter_with_checkpoint(tmp_path)
+    failing = Fact("failing", fail=True)
+
+    submit_entity(submitter, progress, "c", failing, Fact("ok"))
+    submit_entity(submitter, progress, "d", Fact("other"))
+    submitter.flush()
+
+    # A duplicate of the failed fact is skipped, and also fails the entity
+    submit_entity(submitter, progress, "e", Fact("failing", fail=True), Fact("more"))
+    submitter.close()
+
+    assert committed(progress) == ["d"]
+    assert progress.completed == {"d"}
+
+
+def test_failed_batch_does_not_block_later_batches(tmp_path):
+    (submitter, progress) = submitter_with_checkpoint(tmp_path)
+
+    submit_entity(submitter, progress, "f", Fact("failing", fail=True))
+    submitter.flush()
+    submit_entity(submitter, progress, "g", Fact("ok"))
+    submitter.close()
+
+    assert committed(progress) == ["g"]
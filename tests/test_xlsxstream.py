@@ -0,0 +1,137 @@
+""" Tests of bootstrap/xlsxstream.py, with workbooks written by the tests """
+
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bootstrap"))
+
+import xlsxstream  # noqa: E402
+
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+          xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+  <sheets>
+    <sheet name="Other" sheetId="1" r:id="rId1"/>
+    <sheet name="IOCs" sheetId="2" r:id="rId2"/>
+  </sheets>
+</workbook>"""
+
+RELS = """<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+  <Relationship Id="rId1" Target="worksheets/sheet1.xml"/>
+  <Relationship Id="rId2" Target="/xl/worksheets/sheet2.xml"/>
+</Relationships>"""
+
+SHARED_STRINGS = """<?xml version="1.0" encoding="UTF-8"?>
+<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+  <si><t>md5</t></si>
+  <si><t>campaign</t></si>
+  <si><r><t>Carb</t></r><r><t>anak</t></r><rPh><t>hint</t></rPh></si>
+  <si><t>evil.example.com:443</t></si>
+</sst>"""
+
+SHEET = """<?xml version="1.0" encoding="UTF-8"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+  <sheetData>%s</sheetData>
+</worksheet>"""
+
+OTHER_ROWS = '<row r="1"><c r="A1" t="inlineStr"><is><t>other</t></is></c></row>'
+
+IOC_ROWS = """
+<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="s"><v>1</v></c></row>
+<row r="2">
+  <c r="A2" t="inlineStr"><is><t>0123abcd</t></is></c>
+  <c r="B2" t="s"><v>2</v></c>
+  <c r="E2" t="s"><v>3</v></c>
+  <c r="G2" t="str"><v>10.0.0.1</v></c>
+  <c r="H2"><v>8080</v></c>
+</row>
+<row r="3"><c r="A3"><v>1.5</v></c><c r="C3" t="b"><v>1</v></c><c r="D3"/></row>
+"""
+
+
+def workbook(shared_strings=True):
+    """ XLSX workbook with the sheets Other and IOCs """
+    f = io.BytesIO()
+
+    with zipfile.ZipFile(f, "w") as z:
+        z.writestr("xl/workbook.xml", WORKBOOK)
+        z.writestr("xl/_rels/workbook.xml.rels", RELS)
+        z.writestr("xl/worksheets/sheet1.xml", SHEET % OTHER_ROWS)
+        z.writestr("xl/worksheets/sheet2.xml", SHEET % IOC_ROWS)
+        if shared_strings:
+            z.writestr("xl/sharedStrings.xml", SHARED_STRINGS)
+
+    f.seek(0)
+    return f
+
+
+class Stream(io.RawIOBase):
+    """ Binary stream that can not seek, like a download """
+
+    def __init__(self, data):
+        self.f = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.f.readinto(b)
+
+
+def test_iter_rows():
+    assert list(xlsxstream.iter_rows(workbook(), "IOCs")) == [
+        ["md5", "campaign"],
+        ["0123abcd", "Carbanak", "", "", "evil.example.com:443", "", "10.0.0.1", 8080],
+        [1.5, "", True, ""],
+    ]
+    assert list(xlsxstream.iter_rows(workbook(), "Other")) == [["other"]]
+
+
+def test_iter_rows_stream():
+    rows = list(xlsxstream.iter_rows(Stream(workbook().getvalue()), "IOCs"))
+    assert rows[1][1] == "Carbanak"
+
+
+def test_without_shared_strings():
+    assert list(xlsxstream.iter_rows(workbook(shared_strings=False), "Other")) == [["other"]]
+
+
+def test_missing_sheet():
+    with pytest.raises(KeyError):
+        list(xlsxstream.iter_rows(workbook(), "Sheet1"))
+
+
+@pytest.mark.parametrize("column, value", [
+    ("A", "a"),
+    ("C", ""),
+    ("AA", ""),
+    ("E:", ["e", "g", "h"]),
+    ("E:G", ["e", "g"]),
+    ("F:F", []),
+    ("H:", ["h"]),
+    ("I:", []),
+    ("A:B", ["a", "b"]),
+])
+def test_map_row(column, value):
+    row = ["a", "b", "", "d", "e", "", "g", "h"]
+    assert xlsxstream.map_row(row, {"field": column}) == {"field": value}
+
+
+@pytest.mark.parametrize("column", ["a", "E-G", "1", ":E", ""])
+def test_map_row_invalid(column):
+    with pytest.raises(ValueError):
+        xlsxstream.map_row(["a"], {"field": column})
+
+
+def test_iter_mapped_rows():
+    config = {"sheet": "IOCs", "header_rows": 1, "columns": {"md5": "A", "campaign": "B", "c2": "E:"}}
+
+    assert list(xlsxstream.iter_mapped_rows(workbook(), config)) == [
+        {"md5": "0123abcd", "campaign": "Carbanak", "c2": ["evil.example.com:443", "10.0.0.1", 8080]},
+        {"md5": 1.5, "campaign": "", "c2": []},
+    ]